@@ -0,0 +1,118 @@
+import gzip
+import hashlib
+import json
+from mimetypes import guess_type
+import os
+import shutil
+
+import brotli
+from starlette.datastructures import Headers
+from starlette.middleware.gzip import GZipMiddleware
+from starlette.responses import FileResponse
+from starlette.staticfiles import NotModifiedResponse, StaticFiles
+
+STATIC_DIR = "static"
+DIST_DIR = os.path.join(STATIC_DIR, "dist")
+MANIFEST = os.path.join(DIST_DIR, "manifest.json")
+COMPRESSIBLE = {".css", ".js", ".svg", ".ico", ".json", ".html", ".txt"}
+IMMUTABLE = "public, max-age=31536000, immutable"
+
+manifest = None
+
+
+def build():
+    # Copy every static file to dist/ under a content-hashed name, with
+    # .gz and .br variants for text formats, and record the mapping.
+    shutil.rmtree(DIST_DIR, ignore_errors=True)
+    os.makedirs(DIST_DIR)
+    mapping = {}
+    for root, dirs, files in os.walk(STATIC_DIR):
+        dirs[:] = [d for d in dirs if os.path.join(root, d) != DIST_DIR]
+        for name in files:
+            source = os.path.join(root, name)
+            relpath = os.path.relpath(source, STATIC_DIR)
+            with open(source, "rb") as f:
+                content = f.read()
+            digest = hashlib.sha256(content).hexdigest()[:12]
+            stem, ext = os.path.splitext(relpath)
+            target = f"{stem}.{digest}{ext}"
+            output = os.path.join(DIST_DIR, target)
+            os.makedirs(os.path.dirname(output), exist_ok=True)
+            with open(output, "wb") as f:
+                f.write(content)
+            if ext in COMPRESSIBLE:
+                with open(f"{output}.gz", "wb") as f:
+                    f.write(gzip.compress(content, compresslevel=9, mtime=0))
+                with open(f"{output}.br", "wb") as f:
+                    f.write(brotli.compress(content, quality=11))
+            mapping[f"/{relpath}"] = f"/dist/{target}"
+    with open(MANIFEST, "w") as f:
+        json.dump(mapping, f, indent=2)
+    return mapping
+
+
+def asset(path):
+    # Fingerprinted path for url_for('static', ...); falls back to the
+    # original file when assets haven't been built.
+    global manifest
+    if manifest is None:
+        try:
+            with open(MANIFEST) as f:
+                manifest = json.load(f)
+        except FileNotFoundError:
+            manifest = {}
+    return manifest.get(path, path)
+
+
+class PrecompressedStaticFiles(StaticFiles):
+    """Serves a .br or .gz sibling when the client accepts it, and marks
+    fingerprinted files under dist/ as immutable."""
+
+    def file_response(self, full_path, stat_result, scope, status_code=200):
+        request_headers = Headers(scope=scope)
+        accept = request_headers.get("accept-encoding", "")
+        response = None
+        for encoding, suffix in (("br", ".br"), ("gzip", ".gz")):
+            candidate = f"{full_path}{suffix}"
+            if encoding in accept and os.path.isfile(candidate):
+                response = FileResponse(
+                    candidate,
+                    status_code=status_code,
+                    stat_result=os.stat(candidate),
+                    media_type=guess_type(str(full_path))[0],
+                )
+                response.headers["Content-Encoding"] = encoding
+                break
+        if response is None:
+            response = FileResponse(
+                full_path, status_code=status_code, stat_result=stat_result
+            )
+        response.headers.add_vary_header("Accept-Encoding")
+        if os.path.abspath(full_path).startswith(os.path.abspath(DIST_DIR) + os.sep):
+            response.headers["Cache-Control"] = IMMUTABLE
+        if self.is_not_modified(response.headers, request_headers):
+            return NotModifiedResponse(response.headers)
+        return response
+
+
+class CompressionMiddleware:
+    """GZip for larger HTML responses. Static files are already compressed
+    and event streams must not be buffered, so those paths are skipped."""
+
+    def __init__(self, app, minimum_size=1024, compresslevel=6, exclude=()):
+        self.app = app
+        self.gzip = GZipMiddleware(app, minimum_size, compresslevel)
+        self.exclude = tuple(exclude)
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] == "http":
+            path = scope["path"].removeprefix(scope.get("root_path", ""))
+            if not path.startswith(self.exclude):
+                await self.gzip(scope, receive, send)
+                return
+        await self.app(scope, receive, send)
+
+
+if __name__ == "__main__":
+    for source, target in build().items():
+        print(f"{source} -> {target}")
@@ -0,0 +1,101 @@
+import argparse
+import os
+import threading
+import time
+
+BANDWIDTH_SHAPING = os.getenv("BANDWIDTH_SHAPING", "true").lower() != "false"
+BANDWIDTH_CHUNK = int(os.getenv("BANDWIDTH_CHUNK", 4 * 1024 * 1024))
+BANDWIDTH_BURST = float(os.getenv("BANDWIDTH_BURST", 1))
+
+# Rates in bytes/s, read on every reservation so they can be changed while
+# transfers run. Fields are "<host>" for everything from a host and
+# "<host>:<priority>" for one priority class; a missing field falls back to
+# the BANDWIDTH_LIMIT environment defaults and 0 means unlimited.
+LIMITS_KEY = "bandwidth_limits"
+BUCKET_PREFIX = "bandwidth_"
+
+# Takes ARGV[1] bytes from every bucket in KEYS[2..] that has a rate, even
+# if that leaves it in debt, and returns how long the caller must sleep for
+# the debt to be repaid. Each bucket holds up to ARGV[2] seconds of burst.
+RESERVE = """
+local time = redis.call('TIME')
+local now = tonumber(time[1]) + tonumber(time[2]) / 1000000
+local amount = tonumber(ARGV[1])
+local burst = tonumber(ARGV[2])
+local wait = 0
+for i = 2, #KEYS do
+    local field = ARGV[2 * i - 1]
+    local rate = tonumber(redis.call('HGET', KEYS[1], field) or ARGV[2 * i])
+    if rate and rate > 0 then
+        local capacity = rate * burst
+        local state = redis.call('HMGET', KEYS[i], 'tokens', 'time')
+        local tokens = tonumber(state[1]) or capacity
+        local last = tonumber(state[2]) or now
+        tokens = math.min(capacity, tokens + (now - last) * rate) - amount
+        redis.call('HSET', KEYS[i], 'tokens', tokens, 'time', now)
+        redis.call('EXPIRE', KEYS[i], math.ceil(burst - tokens / rate) + 60)
+        if tokens < 0 then
+            wait = math.max(wait, -tokens / rate)
+        end
+    end
+end
+return tostring(wait)
+"""
+
+
+def limit(priority=None):
+    # Environment default for a host or, with a priority, a class within it.
+    if priority is None:
+        return float(os.getenv("BANDWIDTH_LIMIT", 0))
+    return float(os.getenv(f"BANDWIDTH_LIMIT_{priority.upper()}", 0))
+
+
+def setLimit(client, host, rate, priority=None):
+    field = host if priority is None else f"{host}:{priority}"
+    if rate is None:
+        return client.hdel(LIMITS_KEY, field)
+    return client.hset(LIMITS_KEY, field, rate)
+
+
+class Throttle:
+    """Paces one transfer against the shared budgets of its host and its
+    priority class. Bytes are counted locally and reserved from Redis a
+    chunk at a time, so a fast transfer costs one round trip per chunk."""
+
+    def __init__(self, client, host, priority, chunk=BANDWIDTH_CHUNK):
+        self.reserve = client.register_script(RESERVE)
+        self.keys = [
+            LIMITS_KEY,
+            f"{BUCKET_PREFIX}{host}",
+            f"{BUCKET_PREFIX}{host}:{priority}",
+        ]
+        self.args = [host, limit(), f"{host}:{priority}", limit(priority)]
+        self.chunk = chunk
+        self.pending = 0
+        self.lock = threading.Lock()
+
+    def __call__(self, length):
+        # Called from every range's thread after each read.
+        with self.lock:
+            self.pending += length
+            if self.pending < self.chunk:
+                return
+            amount, self.pending = self.pending, 0
+        wait = float(
+            self.reserve(keys=self.keys, args=[amount, BANDWIDTH_BURST, *self.args])
+        )
+        if wait > 0:
+            time.sleep(wait)
+
+
+if __name__ == "__main__":
+    import redis
+
+    parser = argparse.ArgumentParser(description="Change a bandwidth budget.")
+    parser.add_argument("host")
+    parser.add_argument("rate", help="bytes/s, 0 for unlimited, - to reset")
+    parser.add_argument("--priority")
+    args = parser.parse_args()
+    client = redis.Redis.from_url(os.getenv("REDIS_URL", "redis://localhost:6379/0"))
+    rate = None if args.rate == "-" else float(args.rate)
+    setLimit(client, args.host, rate, args.priority)
@@ -0,0 +1,53 @@
+"""Compare the Jinja TemplateResponse path with the precompiled Fragment
+path for a progress poll.
+
+    python benchmarks/bench_fragments.py [--number N]
+"""
+
+import argparse
+import os
+import sys
+import timeit
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+os.chdir(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from fastapi.responses import HTMLResponse
+from starlette.requests import Request
+
+from main import ROOT_PATH, progressFragment, templates
+
+
+def template_response(request, progress):
+    context = {
+        "request": request,
+        "rootPath": ROOT_PATH,
+        "progress": progress,
+        "id": "bench",
+    }
+    return templates.TemplateResponse("progress.html", context)
+
+
+def fragment_response(request, progress):
+    return HTMLResponse(progressFragment.render(progress=progress))
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--number", type=int, default=20000)
+    args = parser.parse_args()
+
+    request = Request({"type": "http", "method": "GET", "headers": []})
+    assert template_response(request, 42).body == fragment_response(request, 42).body
+    for name, render in (
+        ("TemplateResponse", template_response),
+        ("Fragment", fragment_response),
+    ):
+        seconds = min(
+            timeit.repeat(lambda: render(request, 42), number=args.number, repeat=5)
+        )
+        print(f"{name:>16}: {seconds / args.number * 1e6:8.2f} us/response")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,407 @@
+"""Load-test the FastAPI app with realistic htmx traffic.
+
+Starts Redis and Postgres stand-ins (fakeredis over TCP and an embedded
+pgserver Postgres) unless --redis-url/--postgres-uri point at real ones,
+runs main:app under uvicorn, replays what the pages do (progress streams
+for copies, the job bar's /job/progress polls, the task list's batch
+polls), /tasks loads, /copy bursts and index views, and prints per-route
+throughput and latency percentiles as JSON. A stream's latency is the time
+to its first event.
+
+    pip install -r benchmarks/requirements.txt
+    python benchmarks/bench_http.py --duration 30 --streams 200 -o run.json
+"""
+
+import argparse
+import asyncio
+import json
+import os
+import random
+import socket
+import subprocess
+import sys
+import tempfile
+import time
+
+import httpx
+from psycopg.conninfo import conninfo_to_dict
+from psycopg_pool import ConnectionPool
+import redis.asyncio as aioredis
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+from db_ops import createTable, insert  # noqa: E402
+from progress import publishProgress, setProgress  # noqa: E402
+from sampledata import samplefiles  # noqa: E402
+
+FAKEREDIS_SERVER = """
+import sys
+from fakeredis import TcpFakeServer
+TcpFakeServer(("127.0.0.1", int(sys.argv[1])), server_type="redis").serve_forever()
+"""
+
+
+def freePort():
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+
+def waitForPort(port, timeout=30):
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        try:
+            with socket.create_connection(("127.0.0.1", port), timeout=0.5):
+                return
+        except OSError:
+            time.sleep(0.1)
+    raise RuntimeError(f"nothing listening on port {port}")
+
+
+def percentile(values, fraction):
+    if not values:
+        return None
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, int(fraction * len(ordered)))]
+
+
+def gitCommit():
+    try:
+        return subprocess.run(
+            ["git", "rev-parse", "--short", "HEAD"],
+            cwd=ROOT,
+            capture_output=True,
+            text=True,
+            check=True,
+        ).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+class Recorder:
+    def __init__(self):
+        self.latencies = {}
+        self.statuses = {}
+        self.errors = {}
+        self.events = {}
+
+    async def request(self, client, route, method, url, **kwargs):
+        start = time.perf_counter()
+        try:
+            response = await client.request(method, url, **kwargs)
+        except httpx.HTTPError:
+            self.errors[route] = self.errors.get(route, 0) + 1
+            return None
+        self.latencies.setdefault(route, []).append(time.perf_counter() - start)
+        statuses = self.statuses.setdefault(route, {})
+        statuses[response.status_code] = statuses.get(response.status_code, 0) + 1
+        return response
+
+    async def stream(self, client, route, url):
+        # Reads a server-sent event stream to its end and returns the names of
+        # the events received.
+        start = time.perf_counter()
+        names = []
+        try:
+            async with client.stream("GET", url) as response:
+                statuses = self.statuses.setdefault(route, {})
+                statuses[response.status_code] = (
+                    statuses.get(response.status_code, 0) + 1
+                )
+                async for line in response.aiter_lines():
+                    if not line.startswith("event: "):
+                        continue
+                    if not names:
+                        self.latencies.setdefault(route, []).append(
+                            time.perf_counter() - start
+                        )
+                    names.append(line.removeprefix("event: "))
+                    self.events[route] = self.events.get(route, 0) + 1
+        except httpx.HTTPError:
+            self.errors[route] = self.errors.get(route, 0) + 1
+        return names
+
+    def report(self, elapsed):
+        routes = {}
+        for route in sorted(set(self.latencies) | set(self.errors)):
+            latencies = self.latencies.get(route, [])
+            routes[route] = {
+                "requests": len(latencies),
+                "errors": self.errors.get(route, 0),
+                "statuses": {
+                    str(k): v for k, v in self.statuses.get(route, {}).items()
+                },
+                "throughput_rps": len(latencies) / elapsed,
+                "events": self.events.get(route),
+                "p50_ms": ms(percentile(latencies, 0.50)),
+                "p95_ms": ms(percentile(latencies, 0.95)),
+                "p99_ms": ms(percentile(latencies, 0.99)),
+            }
+        return routes
+
+
+def ms(seconds):
+    return None if seconds is None else round(seconds * 1000, 3)
+
+
+async def streamer(client, recorder, id, stop):
+    # Behaves like copying.html: follows the task's progress stream and, once
+    # it is done, fetches the finished fragment. The producer restarts the
+    # task, so the stream is then opened again.
+    while not stop.is_set():
+        names = await recorder.stream(
+            client, "GET /task/stream/{id}", f"/task/stream/{id}"
+        )
+        if "done" in names:
+            await recorder.request(client, "GET /task/{id}", "GET", f"/task/{id}")
+        await asyncio.sleep(1)
+
+
+async def jobPoller(client, recorder, interval, stop):
+    # Behaves like running.html: starts a job and polls its bar until the
+    # server stops the polling, then starts another.
+    await asyncio.sleep(random.uniform(0, interval))
+    while not stop.is_set():
+        id = f"job-{random.getrandbits(64):x}"
+        await recorder.request(client, "POST /start/{id}", "POST", f"/start/{id}")
+        while not stop.is_set():
+            await asyncio.sleep(interval)
+            response = await recorder.request(
+                client,
+                "GET /job/progress/{id}",
+                "GET",
+                f"/job/progress/{id}",
+                headers={"HX-Request": "true"},
+            )
+            if response is None or response.status_code != 200:
+                break
+        await recorder.request(client, "GET /job/{id}", "GET", f"/job/{id}")
+
+
+async def batchPoller(client, recorder, ids, interval, stop):
+    query = "&".join(f"id={id}" for id in ids)
+    await asyncio.sleep(random.uniform(0, interval))
+    while not stop.is_set():
+        await recorder.request(
+            client, "GET /tasks/progress", "GET", f"/tasks/progress?{query}"
+        )
+        await asyncio.sleep(interval)
+
+
+async def periodic(rate, stop, action):
+    if rate <= 0:
+        return
+    while not stop.is_set():
+        await action()
+        await asyncio.sleep(random.expovariate(rate))
+
+
+async def producer(redis_url, ids, stop):
+    # Stands in for the copy workers: moves every task forward a little and
+    # starts finished ones over.
+    cache = aioredis.from_url(redis_url, decode_responses=True)
+    transferred = {id: 0 for id in ids}
+    while not stop.is_set():
+        pipe = cache.pipeline(transaction=False)
+        for id in ids:
+            if transferred[id] == 1000:
+                transferred[id] = 0
+            elif random.random() < 0.3:
+                transferred[id] = min(1000, transferred[id] + random.randint(1, 20))
+            else:
+                continue
+            publishProgress(pipe, id, transferred[id], 1000)
+        await pipe.execute()
+        await asyncio.sleep(0.5)
+    await cache.aclose()
+
+
+async def traffic(args, base_url, ids):
+    # Streams end at once for tasks without progress, so start them all at 0.
+    cache = aioredis.from_url(args.redis_url, decode_responses=True)
+    pipe = cache.pipeline(transaction=False)
+    for id in ids:
+        setProgress(pipe, id, 0, 1000)
+    await pipe.execute()
+    await cache.aclose()
+    recorder = Recorder()
+    stop = asyncio.Event()
+    connections = args.streams + args.job_pollers + args.batch_pollers + 50
+    limits = httpx.Limits(max_connections=connections)
+    async with httpx.AsyncClient(
+        base_url=base_url, limits=limits, timeout=30
+    ) as client:
+
+        async def loadTasks():
+            await recorder.request(client, "GET /tasks", "GET", "/tasks")
+
+        async def viewIndex():
+            await recorder.request(
+                client, "GET /", "GET", "/", headers={"Accept-Encoding": "gzip"}
+            )
+
+        async def copyBurst():
+            await asyncio.gather(
+                *(
+                    recorder.request(
+                        client,
+                        "POST /copy",
+                        "POST",
+                        "/copy",
+                        json={"filename": random.choice(samplefiles)},
+                    )
+                    for _ in range(args.copy_burst)
+                )
+            )
+
+        # Open streams only end with their task, so they are cancelled.
+        streams = [
+            asyncio.create_task(streamer(client, recorder, ids[i % len(ids)], stop))
+            for i in range(args.streams)
+        ]
+        jobs = [
+            jobPoller(client, recorder, args.interval, stop)
+            for _ in range(args.job_pollers)
+        ]
+        jobs += [
+            batchPoller(client, recorder, ids[: args.batch_size], args.interval, stop)
+            for _ in range(args.batch_pollers)
+        ]
+        jobs += [
+            periodic(args.tasks_rate, stop, loadTasks),
+            periodic(args.index_rate, stop, viewIndex),
+            periodic(args.copy_rate, stop, copyBurst),
+            producer(args.redis_url, ids, stop),
+        ]
+        tasks = [asyncio.create_task(job) for job in jobs]
+        start = time.perf_counter()
+        await asyncio.sleep(args.duration)
+        stop.set()
+        await asyncio.gather(*tasks)
+        for stream in streams:
+            stream.cancel()
+        await asyncio.gather(*streams, return_exceptions=True)
+        elapsed = time.perf_counter() - start
+    return recorder.report(elapsed), elapsed
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--duration", type=float, default=30)
+    parser.add_argument("--warmup", type=float, default=2)
+    parser.add_argument("--streams", type=int, default=100)
+    parser.add_argument("--job-pollers", type=int, default=20)
+    parser.add_argument("--batch-pollers", type=int, default=10)
+    parser.add_argument("--batch-size", type=int, default=20)
+    parser.add_argument("--interval", type=float, default=0.6)
+    parser.add_argument("--active-tasks", type=int, default=50)
+    parser.add_argument("--tasks-rate", type=float, default=2, help="/tasks loads/s")
+    parser.add_argument("--index-rate", type=float, default=5, help="index views/s")
+    parser.add_argument("--copy-rate", type=float, default=0.2, help="/copy bursts/s")
+    parser.add_argument("--copy-burst", type=int, default=20)
+    parser.add_argument("--workers", type=int, default=1)
+    parser.add_argument("--redis-url")
+    parser.add_argument("--postgres-uri")
+    parser.add_argument("-o", "--output", help="write JSON results here")
+    args = parser.parse_args()
+
+    processes = []
+    tmpdir = tempfile.TemporaryDirectory()
+    pg = None
+    try:
+        if args.redis_url is None:
+            redis_port = freePort()
+            processes.append(
+                subprocess.Popen(
+                    [sys.executable, "-c", FAKEREDIS_SERVER, str(redis_port)],
+                    stdout=sys.stderr,
+                )
+            )
+            waitForPort(redis_port)
+            args.redis_url = f"redis://127.0.0.1:{redis_port}/0"
+        if args.postgres_uri is None:
+            import pgserver
+
+            pg = pgserver.get_server(tmpdir.name, cleanup_mode="stop")
+            args.postgres_uri = pg.get_uri()
+
+        postgres = conninfo_to_dict(args.postgres_uri)
+        with ConnectionPool(
+            args.postgres_uri, kwargs={"autocommit": True}, min_size=1
+        ) as pool:
+            createTable(pool)
+            with pool.connection() as conn:
+                conn.execute("DELETE FROM tasks")
+            ids = [f"bench-{i}" for i in range(args.active_tasks)]
+            for id in ids:
+                insert(pool, id, random.choice(samplefiles))
+
+        port = freePort()
+        env = dict(
+            os.environ,
+            REDIS_URL=args.redis_url,
+            CELERY_BROKER_URL=args.redis_url,
+            CELERY_RESULT_BACKEND=args.redis_url,
+            POSTGRES_DB=postgres.get("dbname", "postgres"),
+            POSTGRES_USER=postgres.get("user", "postgres"),
+            POSTGRES_PASSWORD=postgres.get("password") or "bench",
+            POSTGRES_HOST=postgres.get("host", "localhost"),
+            POSTGRES_PORT=str(postgres.get("port", 5432)),
+            # Measure the handlers, not the 1/second limits.
+            RATE_LIMIT_INDEX="1000000/second",
+        )
+        processes.append(
+            subprocess.Popen(
+                [
+                    sys.executable,
+                    "-m",
+                    "uvicorn",
+                    "main:app",
+                    "--port",
+                    str(port),
+                    "--workers",
+                    str(args.workers),
+                    "--log-level",
+                    "warning",
+                    "--no-access-log",
+                ],
+                cwd=ROOT,
+                env=env,
+                stdout=sys.stderr,
+            )
+        )
+        waitForPort(port)
+        base_url = f"http://127.0.0.1:{port}"
+
+        if args.warmup:
+            warmup = argparse.Namespace(**{**vars(args), "duration": args.warmup})
+            asyncio.run(traffic(warmup, base_url, ids))
+        routes, elapsed = asyncio.run(traffic(args, base_url, ids))
+        result = {
+            "commit": gitCommit(),
+            "timestamp": time.strftime("%Y-%m-%dT%H:%M:%SZ", time.gmtime()),
+            "duration_s": round(elapsed, 3),
+            "config": {
+                key: value
+                for key, value in vars(args).items()
+                if key not in ("output", "redis_url", "postgres_uri")
+            },
+            "routes": routes,
+        }
+        output = json.dumps(result, indent=2)
+        if args.output:
+            with open(args.output, "w") as f:
+                f.write(output)
+        print(output)
+    finally:
+        for process in reversed(processes):
+            process.terminate()
+            process.wait()
+        if pg is not None:
+            pg.cleanup()
+        tmpdir.cleanup()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,117 @@
+"""Measure cold import time of the web app.
+
+Imports the module (main by default) in fresh interpreters with
+-X importtime and prints the median wall time of the interpreter, the
+median import time of the module itself, and its slowest direct imports as
+JSON. Also lists any modules the web process should never load, such as
+celery or paramiko.
+
+    python benchmarks/bench_import.py --runs 10 -o import.json
+"""
+
+import argparse
+import json
+import os
+import statistics
+import subprocess
+import sys
+import time
+
+from bench_http import gitCommit
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+UNWANTED = ("celery", "kombu", "paramiko", "dotenv", "tasks", "pyinstrument")
+
+CHECK = """
+import sys
+import {module}
+print(",".join(name for name in {unwanted!r} if name in sys.modules))
+"""
+
+
+def parseImportTime(stderr):
+    # Cumulative microseconds by module and nesting depth from -X importtime,
+    # where each level of nesting indents the name by two spaces.
+    entries = []
+    for line in stderr.splitlines():
+        if not line.startswith("import time:"):
+            continue
+        _, cumulative, name = line.split("|", 2)
+        if not cumulative.strip().isdigit():
+            continue
+        name = name[1:]
+        depth = (len(name) - len(name.lstrip())) // 2
+        entries.append((depth, name.strip(), int(cumulative)))
+    return entries
+
+
+def run(module):
+    start = time.perf_counter()
+    result = subprocess.run(
+        [
+            sys.executable,
+            "-X",
+            "importtime",
+            "-c",
+            CHECK.format(module=module, unwanted=UNWANTED),
+        ],
+        cwd=ROOT,
+        capture_output=True,
+        text=True,
+        check=True,
+    )
+    elapsed = time.perf_counter() - start
+    entries = parseImportTime(result.stderr)
+    total = next(us for depth, name, us in entries if depth == 0 and name == module)
+    direct = {name: us for depth, name, us in entries if depth == 1}
+    loaded = [name for name in result.stdout.strip().split(",") if name]
+    return elapsed, total, direct, loaded
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--module", default="main")
+    parser.add_argument("--runs", type=int, default=10)
+    parser.add_argument("--top", type=int, default=15)
+    parser.add_argument("-o", "--output", help="write JSON results here")
+    args = parser.parse_args()
+
+    # The first run warms the bytecode cache so every measured run is
+    # comparable.
+    run(args.module)
+    wall, totals, direct, loaded = [], [], {}, set()
+    for _ in range(args.runs):
+        elapsed, total, imports, unwanted = run(args.module)
+        wall.append(elapsed)
+        totals.append(total)
+        for name, us in imports.items():
+            direct.setdefault(name, []).append(us)
+        loaded.update(unwanted)
+
+    slowest = sorted(
+        ((name, statistics.median(times)) for name, times in direct.items()),
+        key=lambda item: item[1],
+        reverse=True,
+    )[: args.top]
+    result = {
+        "commit": gitCommit(),
+        "timestamp": time.strftime("%Y-%m-%dT%H:%M:%SZ", time.gmtime()),
+        "python": sys.version.split()[0],
+        "module": args.module,
+        "runs": args.runs,
+        "interpreter_ms_median": round(statistics.median(wall) * 1000, 1),
+        "import_ms_median": round(statistics.median(totals) / 1000, 1),
+        "import_ms_min": round(min(totals) / 1000, 1),
+        "slowest_imports_ms": {name: round(us / 1000, 1) for name, us in slowest},
+        "unwanted_modules": sorted(loaded),
+    }
+    output = json.dumps(result, indent=2)
+    if args.output:
+        with open(args.output, "w") as f:
+            f.write(output)
+    print(output)
+
+
+if __name__ == "__main__":
+    main()
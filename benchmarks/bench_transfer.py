@@ -0,0 +1,240 @@
+"""Measure copyFile transfers against a loopback SFTP server.
+
+Generates files of the given sizes, serves them from an in-process
+paramiko SFTP server (optionally behind simulated latency and bandwidth),
+and runs tasks.copyFile directly, without a broker. Redis is an in-process
+fakeredis that counts commands and Postgres an embedded pgserver unless
+--postgres-uri is given. Prints MB/s, time to first byte, handshake cost
+and Redis commands per transfer as JSON.
+
+    pip install -r benchmarks/requirements.txt
+    python benchmarks/bench_transfer.py --sizes 1M,64M,256M --count 3 \\
+        --latency-ms 40 --bandwidth-mbps 200 -o transfer.json
+"""
+
+import argparse
+import json
+import os
+import statistics
+import sys
+import tempfile
+import time
+
+import fakeredis
+from psycopg.conninfo import conninfo_to_dict
+from redis.client import Pipeline
+
+from bench_http import gitCommit
+import sftpserver
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+READS = {"GET", "MGET", "HGET", "HGETALL", "EXISTS"}
+UNITS = {"K": 1024, "M": 1024**2, "G": 1024**3}
+
+
+def parseSize(value):
+    value = value.strip().upper().removesuffix("B")
+    if value[-1] in UNITS:
+        return int(float(value[:-1]) * UNITS[value[-1]])
+    return int(value)
+
+
+class CountingRedis(fakeredis.FakeRedis):
+    """In-process Redis that records the name of every command sent,
+    including those queued on pipelines."""
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.commands = []
+
+    def execute_command(self, *args, **options):
+        self.commands.append(str(args[0]).upper())
+        return super().execute_command(*args, **options)
+
+    def pipeline(self, transaction=True, shard_hint=None):
+        commands = self.commands
+
+        class CountingPipeline(Pipeline):
+            def pipeline_execute_command(self, *args, **options):
+                commands.append(str(args[0]).upper())
+                return super().pipeline_execute_command(*args, **options)
+
+        return CountingPipeline(
+            self.connection_pool, self.response_callbacks, transaction, shard_hint
+        )
+
+
+def generateFiles(directory, sizes, count):
+    files = []
+    block = os.urandom(1024 * 1024)
+    for size in sizes:
+        for i in range(count):
+            name = f"bench-{size}-{i}.bin"
+            with open(os.path.join(directory, name), "wb") as f:
+                remaining = size
+                while remaining > 0:
+                    # Vary each block so no two files or blocks are identical.
+                    chunk = os.urandom(16) + block[16 : min(len(block), remaining)]
+                    f.write(chunk[:remaining])
+                    remaining -= len(chunk)
+            files.append((size, name))
+    return files
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--sizes", default="1M,16M,128M")
+    parser.add_argument("--count", type=int, default=3)
+    parser.add_argument("--latency-ms", type=float, default=0, help="one-way")
+    parser.add_argument("--bandwidth-mbps", type=float, default=0)
+    parser.add_argument("--ranges", type=int, help="SFTP_PARALLEL_RANGES")
+    parser.add_argument("--threshold", help="SFTP_PARALLEL_THRESHOLD, e.g. 64M")
+    parser.add_argument("--postgres-uri")
+    parser.add_argument("-o", "--output", help="write JSON results here")
+    args = parser.parse_args()
+
+    sizes = [parseSize(size) for size in args.sizes.split(",")]
+    bandwidth = args.bandwidth_mbps * 1e6 / 8 if args.bandwidth_mbps else None
+    tmpdir = tempfile.TemporaryDirectory()
+    remote = os.path.join(tmpdir.name, "remote")
+    local = os.path.join(tmpdir.name, "local")
+    os.makedirs(remote)
+    os.makedirs(local)
+    pg = None
+    try:
+        files = generateFiles(remote, sizes, args.count)
+        port = sftpserver.serve(remote, args.latency_ms / 1000, bandwidth)
+        if args.postgres_uri is None:
+            import pgserver
+
+            pg = pgserver.get_server(os.path.join(tmpdir.name, "pg"))
+            args.postgres_uri = pg.get_uri()
+        postgres = conninfo_to_dict(args.postgres_uri)
+
+        os.environ.update(
+            REMOTE_HOST="127.0.0.1",
+            REMOTE_PORT=str(port),
+            REMOTE_ROOT_PATH="",
+            LOCAL_ROOT_PATH=local,
+            SSH_USERNAME="bench",
+            SSH_PASSWORD="bench",
+            POSTGRES_DB=postgres.get("dbname", "postgres"),
+            POSTGRES_USER=postgres.get("user", "postgres"),
+            POSTGRES_PASSWORD=postgres.get("password") or "bench",
+            POSTGRES_HOST=postgres.get("host", "localhost"),
+            POSTGRES_PORT=str(postgres.get("port", 5432)),
+        )
+        if args.ranges is not None:
+            os.environ["SFTP_PARALLEL_RANGES"] = str(args.ranges)
+        if args.threshold is not None:
+            os.environ["SFTP_PARALLEL_THRESHOLD"] = str(parseSize(args.threshold))
+
+        import tasks
+
+        tasks.cache = CountingRedis(decode_responses=True)
+        tasks.init_worker()
+        handshakes = []
+        connect = tasks.sftp_pool.connect
+
+        def timedConnect(host):
+            start = time.perf_counter()
+            session = connect(host)
+            handshakes.append(time.perf_counter() - start)
+            return session
+
+        tasks.sftp_pool.connect = timedConnect
+        updateProgress = tasks.updateProgress
+
+        results = []
+        for i, (size, name) in enumerate(files):
+            first_byte = None
+            start = time.perf_counter()
+
+            def watchProgress(id, filename):
+                update = updateProgress(id, filename)
+
+                def watch(transferred, total):
+                    nonlocal first_byte
+                    if first_byte is None and transferred > 0:
+                        first_byte = time.perf_counter() - start
+                    update(transferred, total)
+
+                return watch
+
+            tasks.updateProgress = watchProgress
+            tasks.cache.commands.clear()
+            handshakes_before = len(handshakes)
+            tasks.copyFile.push_request(id=f"bench-{i}")
+            try:
+                tasks.copyFile.run(name)
+            finally:
+                tasks.copyFile.pop_request()
+            elapsed = time.perf_counter() - start
+            assert os.path.getsize(os.path.join(local, name)) == size
+            os.remove(os.path.join(local, name))
+            commands = list(tasks.cache.commands)
+            results.append(
+                {
+                    "size": size,
+                    "seconds": elapsed,
+                    "ttfb": first_byte,
+                    "handshakes": handshakes[handshakes_before:],
+                    "redis_commands": len(commands),
+                    "redis_writes": sum(1 for c in commands if c not in READS),
+                }
+            )
+        tasks.shutdown_worker()
+
+        report = {}
+        for size in sizes:
+            runs = [r for r in results if r["size"] == size]
+            handshake_times = [h for r in runs for h in r["handshakes"]]
+            report[str(size)] = {
+                "transfers": len(runs),
+                "mb_per_s": round(
+                    statistics.median(size / r["seconds"] / 1e6 for r in runs), 3
+                ),
+                "seconds_median": round(
+                    statistics.median(r["seconds"] for r in runs), 4
+                ),
+                "ttfb_ms_median": round(
+                    statistics.median(r["ttfb"] or 0 for r in runs) * 1000, 3
+                ),
+                "handshakes": len(handshake_times),
+                "handshake_ms_mean": (
+                    round(statistics.mean(handshake_times) * 1000, 3)
+                    if handshake_times
+                    else None
+                ),
+                "redis_commands_per_transfer": statistics.mean(
+                    r["redis_commands"] for r in runs
+                ),
+                "redis_writes_per_transfer": statistics.mean(
+                    r["redis_writes"] for r in runs
+                ),
+            }
+        result = {
+            "commit": gitCommit(),
+            "timestamp": time.strftime("%Y-%m-%dT%H:%M:%SZ", time.gmtime()),
+            "config": {
+                key: value
+                for key, value in vars(args).items()
+                if key not in ("output", "postgres_uri")
+            },
+            "sizes": report,
+        }
+        output = json.dumps(result, indent=2)
+        if args.output:
+            with open(args.output, "w") as f:
+                f.write(output)
+        print(output)
+    finally:
+        if pg is not None:
+            pg.cleanup()
+        tmpdir.cleanup()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,145 @@
+"""A read-only paramiko SFTP server on loopback for benchmarks, with an
+optional TCP shim that adds latency and caps bandwidth."""
+
+import os
+import queue
+import socket
+import threading
+import time
+
+import paramiko
+from paramiko import (
+    AUTH_SUCCESSFUL,
+    OPEN_SUCCEEDED,
+    SFTPAttributes,
+    SFTPHandle,
+    SFTPServer,
+    SFTPServerInterface,
+    ServerInterface,
+)
+
+
+class Server(ServerInterface):
+    def check_auth_password(self, username, password):
+        return AUTH_SUCCESSFUL
+
+    def get_allowed_auths(self, username):
+        return "password"
+
+    def check_channel_request(self, kind, chanid):
+        return OPEN_SUCCEEDED
+
+
+class Handle(SFTPHandle):
+    def stat(self):
+        return SFTPAttributes.from_stat(os.fstat(self.readfile.fileno()))
+
+
+def serverInterface(root):
+    class Interface(SFTPServerInterface):
+        def path(self, path):
+            return os.path.join(root, path.lstrip("/"))
+
+        def stat(self, path):
+            try:
+                return SFTPAttributes.from_stat(os.stat(self.path(path)))
+            except OSError as error:
+                return SFTPServer.convert_errno(error.errno)
+
+        lstat = stat
+
+        def open(self, path, flags, attr):
+            try:
+                readfile = open(self.path(path), "rb")
+            except OSError as error:
+                return SFTPServer.convert_errno(error.errno)
+            handle = Handle(flags)
+            handle.filename = path
+            handle.readfile = readfile
+            return handle
+
+    return Interface
+
+
+def pipe(source, sink, latency, bandwidth):
+    # Forward one direction of a connection, delivering each chunk latency
+    # seconds after it was read and no faster than bandwidth bytes/s.
+    pending = queue.Queue()
+
+    def reader():
+        while True:
+            try:
+                data = source.recv(65536)
+            except OSError:
+                data = b""
+            pending.put((time.monotonic() + latency, data))
+            if not data:
+                return
+
+    threading.Thread(target=reader, daemon=True).start()
+    sent_until = time.monotonic()
+    while True:
+        due, data = pending.get()
+        delay = due - time.monotonic()
+        if delay > 0:
+            time.sleep(delay)
+        if not data:
+            break
+        if bandwidth:
+            sent_until = max(sent_until, time.monotonic()) + len(data) / bandwidth
+            time.sleep(max(0, sent_until - time.monotonic()))
+        try:
+            sink.sendall(data)
+        except OSError:
+            break
+    for sock in (source, sink):
+        try:
+            sock.shutdown(socket.SHUT_RDWR)
+        except OSError:
+            pass
+
+
+def listen():
+    sock = socket.socket()
+    sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    sock.bind(("127.0.0.1", 0))
+    sock.listen(64)
+    return sock
+
+
+def serve(root, latency=0, bandwidth=None):
+    """Serve root over SFTP and return the port to connect to. latency is
+    the one-way delay in seconds and bandwidth the cap in bytes/s, applied
+    in each direction."""
+    key = paramiko.RSAKey.generate(2048)
+    interface = serverInterface(root)
+    server = listen()
+
+    def accept():
+        while True:
+            conn, _ = server.accept()
+            transport = paramiko.Transport(conn)
+            transport.add_server_key(key)
+            transport.set_subsystem_handler("sftp", SFTPServer, interface)
+            transport.start_server(server=Server())
+
+    threading.Thread(target=accept, daemon=True).start()
+    port = server.getsockname()[1]
+    if not latency and not bandwidth:
+        return port
+
+    shim = listen()
+
+    def forward():
+        while True:
+            client, _ = shim.accept()
+            upstream = socket.create_connection(("127.0.0.1", port))
+            for source, sink in ((client, upstream), (upstream, client)):
+                threading.Thread(
+                    target=pipe,
+                    args=(source, sink, latency, bandwidth),
+                    daemon=True,
+                ).start()
+
+    threading.Thread(target=forward, daemon=True).start()
+    return shim.getsockname()[1]
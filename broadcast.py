@@ -0,0 +1,75 @@
+import asyncio
+from contextlib import asynccontextmanager
+
+from redis.exceptions import RedisError
+
+CHANNEL_PREFIX = "channel_"
+
+
+def channel(id):
+    return f"{CHANNEL_PREFIX}{id}"
+
+
+class Broadcaster:
+    """Fans progress messages out from one Redis pattern subscription to
+    every SSE stream in this process, so open streams don't each hold a
+    Redis connection."""
+
+    def __init__(self, cache):
+        self.cache = cache
+        self.pubsub = None
+        self.listener = None
+        self.subscribers = {}
+
+    async def start(self):
+        self.pubsub = self.cache.pubsub(ignore_subscribe_messages=True)
+        await self.pubsub.psubscribe(f"{CHANNEL_PREFIX}*")
+        self.listener = asyncio.create_task(self.listen())
+        self.listener.add_done_callback(self.stopped)
+
+    def stopped(self, task):
+        # listen() only returns by being cancelled, so anything else leaves
+        # every stream in this process waiting on keepalives.
+        if not task.cancelled():
+            print(f"Progress listener stopped: {task.exception()!r}")
+
+    async def stop(self):
+        if self.listener:
+            self.listener.cancel()
+            try:
+                await self.listener
+            except asyncio.CancelledError:
+                pass
+        if self.pubsub:
+            await self.pubsub.aclose()
+
+    async def listen(self):
+        while True:
+            try:
+                message = await self.pubsub.get_message(
+                    ignore_subscribe_messages=True, timeout=1.0
+                )
+            except RedisError as error:
+                print(f"Progress subscription lost: {error}")
+                await asyncio.sleep(1)
+                continue
+            if message is None:
+                continue
+            id = message["channel"].removeprefix(CHANNEL_PREFIX)
+            for queue in self.subscribers.get(id, ()):
+                # Only the latest value matters, so replace anything unread.
+                if queue.full():
+                    queue.get_nowait()
+                queue.put_nowait(message["data"])
+
+    @asynccontextmanager
+    async def subscribe(self, id):
+        queue = asyncio.Queue(maxsize=1)
+        self.subscribers.setdefault(id, set()).add(queue)
+        try:
+            yield queue
+        finally:
+            queues = self.subscribers.get(id)
+            queues.discard(queue)
+            if not queues:
+                del self.subscribers[id]
@@ -0,0 +1,162 @@
+import bisect
+import hashlib
+import importlib
+import shlex
+import socket
+
+import paramiko
+
+READ_SIZE = 1024 * 1024
+
+# hashlib-style constructor and the remote command printing the same digest
+# in sha256sum format. xxh64 needs the optional xxhash package.
+ALGORITHMS = {
+    "sha256": (hashlib.sha256, "sha256sum"),
+    "blake2b": (hashlib.blake2b, "b2sum"),
+    "xxh64": (lambda: importlib.import_module("xxhash").xxh64(), "xxhsum -H1"),
+}
+
+# Prints blockDigest of each block of a file, for remoteBlocks.
+BLOCK_SCRIPT = """
+import hashlib, sys
+with open(sys.argv[1], "rb") as f:
+    for block in iter(lambda: f.read(int(sys.argv[2])), b""):
+        sys.stdout.write(hashlib.blake2b(block, digest_size=16).hexdigest() + "\\n")
+"""
+
+
+# Prints the digest of each start:length range of a file, for
+# remoteChecksum.
+RANGE_SCRIPT = """
+import hashlib, sys
+name, path = sys.argv[1], sys.argv[2]
+with open(path, "rb") as f:
+    for start, length in (map(int, arg.split(":")) for arg in sys.argv[3:]):
+        h = __import__("xxhash").xxh64() if name == "xxh64" else hashlib.new(name)
+        f.seek(start)
+        while length > 0:
+            block = f.read(min(length, 1 << 20))
+            if not block:
+                break
+            h.update(block)
+            length -= len(block)
+        sys.stdout.write(h.hexdigest() + "\\n")
+"""
+
+
+class ChecksumMismatch(Exception):
+    pass
+
+
+class StreamingHash:
+    """Hashes each range of a transfer as it is written. Every range is
+    written front to back by a single thread, so each hash is fed straight
+    from memory and the file is never read a second time; only bytes kept
+    from an earlier attempt, or anything written out of order, are read
+    back from disk."""
+
+    def __init__(self, algorithm, path, ranges):
+        self.path = path
+        self.starts = [start for start, _ in ranges]
+        self.ends = {start: start + length for start, length in ranges}
+        self.hashes = {start: ALGORITHMS[algorithm][0]() for start in self.starts}
+        self.hashed = {start: start for start in self.starts}
+
+    def update(self, offset, data):
+        start = self.starts[bisect.bisect_right(self.starts, offset) - 1]
+        if offset == self.hashed[start]:
+            self.hashes[start].update(data)
+            self.hashed[start] += len(data)
+
+    def readBack(self, start, end):
+        if end <= self.hashed[start]:
+            return
+        with open(self.path, "rb") as f:
+            f.seek(self.hashed[start])
+            while self.hashed[start] < end:
+                data = f.read(min(READ_SIZE, end - self.hashed[start]))
+                if not data:
+                    raise EOFError(f"{self.path} is shorter than {end} bytes")
+                self.hashes[start].update(data)
+                self.hashed[start] += len(data)
+
+    def hexdigests(self):
+        for start in self.starts:
+            self.readBack(start, self.ends[start])
+        return [self.hashes[start].hexdigest() for start in self.starts]
+
+
+def remoteExec(transport, command, timeout=600):
+    # stdout of a command run on the remote host, or None if it can't be run
+    # or fails.
+    try:
+        channel = transport.open_session(timeout=timeout)
+    except paramiko.SSHException:
+        return None
+    try:
+        channel.settimeout(timeout)
+        channel.exec_command(command)
+        output = []
+        while True:
+            data = channel.recv(65536)
+            if not data:
+                break
+            output.append(data)
+        if channel.recv_exit_status() != 0:
+            return None
+        return b"".join(output)
+    except (paramiko.SSHException, socket.timeout):
+        return None
+    finally:
+        channel.close()
+
+
+def remoteChecksum(sftp, path, algorithm, ranges, timeout=600):
+    # Digest of each (start, length) range of a remote file, or None if it
+    # can't be worked out. A single range covering the file comes from a
+    # <path>.<algorithm> sidecar file if there is one, else from the
+    # checksum tool on the remote host; several ranges need python3 there.
+    # Uses channels of its own so it can run alongside a transfer on the
+    # same session.
+    transport = sftp.get_channel().get_transport()
+    if len(ranges) > 1:
+        spans = [f"{start}:{length}" for start, length in ranges]
+        command = shlex.join(["python3", "-c", RANGE_SCRIPT, algorithm, path, *spans])
+        output = remoteExec(transport, command, timeout)
+        try:
+            digests = output.decode().split()
+        except (AttributeError, UnicodeDecodeError):
+            return None
+        return digests if len(digests) == len(ranges) else None
+    try:
+        with paramiko.SFTPClient.from_transport(transport) as client:
+            with client.open(f"{path}.{algorithm}", "r") as f:
+                return [f.read(4096).decode().split()[0].lower()]
+    except (IOError, IndexError, UnicodeDecodeError, paramiko.SSHException):
+        pass
+    command = ALGORITHMS[algorithm][1]
+    output = remoteExec(transport, f"{command} -- {shlex.quote(path)}", timeout)
+    try:
+        return [output.split()[0].decode().lower().lstrip("\\")]
+    except (AttributeError, IndexError, UnicodeDecodeError):
+        return None
+
+
+def blockDigest(block):
+    return hashlib.blake2b(block, digest_size=16).hexdigest()
+
+
+def localBlocks(path, blockSize):
+    with open(path, "rb") as f:
+        return [blockDigest(block) for block in iter(lambda: f.read(blockSize), b"")]
+
+
+def remoteBlocks(sftp, path, blockSize, timeout=600):
+    # blockDigest of each block of a remote file, worked out on the remote
+    # host with python3. None if it isn't available there.
+    transport = sftp.get_channel().get_transport()
+    command = shlex.join(["python3", "-c", BLOCK_SCRIPT, path, str(blockSize)])
+    output = remoteExec(transport, command, timeout)
+    if output is None:
+        return None
+    return output.decode().split()
@@ -1,7 +1,23 @@
+from profiling import timed
+
+INSERT_TASK = """
+    INSERT INTO tasks(id, filename) VALUES(%s, %s)
+    ON CONFLICT (id) DO UPDATE SET status = 'active', updated = now();
+"""
+
+FINISH_TASK = """
+    UPDATE tasks SET status = %s, checksum = %s, verified = %s, updated = now()
+    WHERE id = %s;
+"""
+
+# Pools are opened with autocommit, so each single statement below is one
+# round trip, and prepare=True keeps its plan on the pooled connection.
+
+
 def createTable(pool):
     with pool.connection() as conn:
-        with conn.cursor() as cursor:
-            cursor.execute(
+        with conn.transaction(), conn.pipeline():
+            conn.execute(
                 """
                 CREATE TABLE IF NOT EXISTS tasks
                 (
@@ -10,32 +26,89 @@ def createTable(pool):
                 )
                 """
             )
-            conn.commit()
+            conn.execute(
+                """
+                ALTER TABLE tasks
+                    ADD COLUMN IF NOT EXISTS STATUS TEXT NOT NULL DEFAULT 'active',
+                    ADD COLUMN IF NOT EXISTS CREATED TIMESTAMPTZ NOT NULL DEFAULT now(),
+                    ADD COLUMN IF NOT EXISTS UPDATED TIMESTAMPTZ NOT NULL DEFAULT now(),
+                    ADD COLUMN IF NOT EXISTS CHECKSUM TEXT,
+                    ADD COLUMN IF NOT EXISTS VERIFIED BOOLEAN
+                """
+            )
+            conn.execute(
+                """
+                CREATE INDEX IF NOT EXISTS tasks_status_created
+                ON tasks (status, created, id)
+                """
+            )
 
 
+@timed("postgres")
 def insert(pool, id, filename):
     with pool.connection() as conn:
-        with conn.cursor() as cursor:
-            cursor.execute(
-                "INSERT INTO tasks(id, filename) VALUES(%s, %s);",
-                (id, filename),
-            )
-            conn.commit()
+        conn.execute(INSERT_TASK, (id, filename), prepare=True)
 
 
-def delete(pool, id):
+@timed("postgres")
+async def insertAsync(pool, id, filename):
+    async with pool.connection() as conn:
+        await conn.execute(INSERT_TASK, (id, filename), prepare=True)
+
+
+@timed("postgres")
+async def insertMany(pool, tasks):
+    ids, filenames = zip(*tasks)
+    async with pool.connection() as conn:
+        await conn.execute(
+            """
+            INSERT INTO tasks(id, filename)
+            SELECT * FROM unnest(%s::text[], %s::text[])
+            ON CONFLICT (id) DO UPDATE SET status = 'active', updated = now();
+            """,
+            (list(ids), list(filenames)),
+            prepare=True,
+        )
+
+
+@timed("postgres")
+def finish(pool, id, status="complete", checksum=None, verified=None):
+    # verified is None when there was no remote checksum to compare with.
     with pool.connection() as conn:
-        with conn.cursor() as cursor:
-            cursor.execute(
-                "DELETE FROM tasks WHERE id=%s;",
-                (id,),
-            )
-            conn.commit()
+        conn.execute(FINISH_TASK, (status, checksum, verified, id), prepare=True)
+
+
+@timed("postgres")
+async def finishAsync(pool, id, status="complete", checksum=None, verified=None):
+    async with pool.connection() as conn:
+        await conn.execute(FINISH_TASK, (status, checksum, verified, id), prepare=True)
 
 
-async def getTasks(pool):
+@timed("postgres")
+async def getTasks(pool, status="active", after=None, limit=50):
+    # Keyset pagination on (created, id): pass the last row's values as
+    # after to get the next page.
     async with pool.connection() as conn:
         async with conn.cursor() as cursor:
-            await cursor.execute("SELECT * FROM tasks;")
+            if after is None:
+                await cursor.execute(
+                    """
+                    SELECT id, filename, status, created FROM tasks
+                    WHERE status = %s
+                    ORDER BY created, id LIMIT %s;
+                    """,
+                    (status, limit),
+                    prepare=True,
+                )
+            else:
+                await cursor.execute(
+                    """
+                    SELECT id, filename, status, created FROM tasks
+                    WHERE status = %s AND (created, id) > (%s, %s)
+                    ORDER BY created, id LIMIT %s;
+                    """,
+                    (status, *after, limit),
+                    prepare=True,
+                )
             results = await cursor.fetchall()
             return results
@@ -0,0 +1,80 @@
+import os
+import threading
+
+# Registry of copies in flight, one key per filename holding the task id
+# copying it. The web app claims a filename before sending copyFile and
+# later requests for it attach to the same task; the worker keeps the claim
+# alive while it runs and releases it once the copy has finished or failed
+# for good. A claim left by a lost task expires COPY_LOCK_TTL seconds after
+# its last refresh, so the TTL also bounds how long a task may sit queued.
+COPY_LOCK_TTL = int(os.getenv("COPY_LOCK_TTL", 3600))
+COPY_PREFIX = "copying:"
+
+# Sets KEYS[1] to ARGV[1] unless it is already claimed and returns the
+# task id that owns it.
+CLAIM = """
+local owner = redis.call('GET', KEYS[1])
+if owner then
+    return owner
+end
+redis.call('SET', KEYS[1], ARGV[1], 'EX', ARGV[2])
+return ARGV[1]
+"""
+
+# Resets the expiry of KEYS[1] to ARGV[2] only if it is still owned by
+# ARGV[1].
+REFRESH = """
+if redis.call('GET', KEYS[1]) == ARGV[1] then
+    return redis.call('EXPIRE', KEYS[1], ARGV[2])
+end
+return 0
+"""
+
+# Deletes KEYS[1] only if it is still owned by ARGV[1].
+RELEASE = """
+if redis.call('GET', KEYS[1]) == ARGV[1] then
+    return redis.call('DEL', KEYS[1])
+end
+return 0
+"""
+
+
+def copyKey(filename):
+    return f"{COPY_PREFIX}{filename}"
+
+
+# Like the progress helpers these only issue commands, so they work on sync
+# and async clients and on pipelines.
+
+
+def claimCopy(client, filename, id, ttl=COPY_LOCK_TTL):
+    return client.register_script(CLAIM)(keys=[copyKey(filename)], args=[id, ttl])
+
+
+def refreshCopy(client, filename, id, ttl=COPY_LOCK_TTL):
+    return client.register_script(REFRESH)(keys=[copyKey(filename)], args=[id, ttl])
+
+
+def releaseCopy(client, filename, id):
+    return client.register_script(RELEASE)(keys=[copyKey(filename)], args=[id])
+
+
+def keepCopy(client, filename, id, ttl=COPY_LOCK_TTL):
+    # For the worker: reclaims filename for id if the claim lapsed while the
+    # task was queued and returns the owner. If that is id, the claim is
+    # refreshed from a thread so waits that report no progress don't let it
+    # expire, until the returned event is set; otherwise the event is None.
+    owner = claimCopy(client, filename, id, ttl)
+    if owner != id:
+        return owner, None
+    stopped = threading.Event()
+
+    def heartbeat():
+        while not stopped.wait(ttl / 3):
+            try:
+                refreshCopy(client, filename, id, ttl)
+            except Exception as error:
+                print(f"Copy claim {filename} heartbeat failed: {error}")
+
+    threading.Thread(target=heartbeat, daemon=True).start()
+    return owner, stopped
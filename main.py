@@ -1,26 +1,52 @@
+import asyncio
 from contextlib import asynccontextmanager
+from datetime import datetime
+import gzip
+import hashlib
 import json
 from typing import Optional
+from urllib.parse import urlencode
 import os
 
-from fastapi import FastAPI, Header, Request, Response, status
-from fastapi.responses import HTMLResponse, JSONResponse
-from fastapi.staticfiles import StaticFiles
+from fastapi import FastAPI, Header, Query, Request, Response, status
+from fastapi.responses import HTMLResponse, JSONResponse, StreamingResponse
 from fastapi.templating import Jinja2Templates
+from prometheus_client import CollectorRegistry
 from psycopg_pool import AsyncConnectionPool
 from psycopg.rows import dict_row
-from pydantic import BaseModel
+from pydantic import BaseModel, field_validator
 from slowapi import _rate_limit_exceeded_handler
 from slowapi.errors import RateLimitExceeded
-import redis
-
-from db_ops import getTasks
+import redis.asyncio as aioredis
+
+from assets import CompressionMiddleware, PrecompressedStaticFiles, asset
+from broadcast import Broadcaster
+from db_ops import finishAsync, getTasks, insertMany
+from fragments import Fragment
+from inflight import claimCopy, releaseCopy
+from producer import COPY_FILE, sendTask, sendTasks, taskId
+from progress import (
+    FAILED,
+    advanceJob,
+    failProgress,
+    jobKey,
+    parseProgress,
+    readProgress,
+    setProgress,
+)
+from profiling import (
+    ENABLED as PROFILING,
+    PROFILE_SAMPLE_RATE,
+    PROFILE_SPANS,
+    ProfilingMiddleware,
+    TimedTemplate,
+)
+from metrics import MetricsMiddleware, PoolCollector, TimedRedis, exposition, registry
 from sampledata import sampleusers, sampletasks, samplefiles
-from routers.limiter import limiter
+from routers.limiter import limiter, rate
 from routers.open_routes import router as open_routes
 from routers.protected_routes import router as protected_routes
 from routers.user_routes import router as user_routes
-from tasks import copyFile
 
 
 def get_conn_str():
@@ -33,23 +59,82 @@ def get_conn_str():
     """
 
 
+POSTGRES_POOL_MIN = int(os.getenv("POSTGRES_POOL_MIN", 4))
+POSTGRES_POOL_MAX = int(os.getenv("POSTGRES_POOL_MAX", POSTGRES_POOL_MIN))
+POSTGRES_POOL_TIMEOUT = float(os.getenv("POSTGRES_POOL_TIMEOUT", 30))
+REDIS_URL = os.getenv("REDIS_URL", "redis://localhost:6379/0")
+REDIS_POOL_MIN = int(os.getenv("REDIS_POOL_MIN", 4))
+REDIS_MAX_CONNECTIONS = int(os.getenv("REDIS_MAX_CONNECTIONS", 50))
+REDIS_POOL_TIMEOUT = float(os.getenv("REDIS_POOL_TIMEOUT", 5))
+REDIS_SOCKET_TIMEOUT = float(os.getenv("REDIS_SOCKET_TIMEOUT", 2))
+SSE_KEEPALIVE = float(os.getenv("SSE_KEEPALIVE", 15))
+
+
+def get_cache():
+    pool = aioredis.BlockingConnectionPool.from_url(
+        REDIS_URL,
+        max_connections=REDIS_MAX_CONNECTIONS,
+        timeout=REDIS_POOL_TIMEOUT,
+        socket_timeout=REDIS_SOCKET_TIMEOUT,
+        socket_connect_timeout=REDIS_SOCKET_TIMEOUT,
+        decode_responses=True,
+    )
+    return TimedRedis(connection_pool=pool)
+
+
+async def prewarm(cache, count):
+    # Connect up front so the first requests after startup don't pay for it.
+    pool = cache.connection_pool
+    count = min(count, REDIS_MAX_CONNECTIONS)
+    connections = await asyncio.gather(
+        *(pool.get_connection("PING") for _ in range(count))
+    )
+    for connection in connections:
+        await pool.release(connection)
+
+
+# Each server process runs its own lifespan, so these pools are per process.
+# The server only starts accepting requests once startup has finished.
 @asynccontextmanager
 async def lifespan(app: FastAPI):
     app.pool = AsyncConnectionPool(
-        conninfo=get_conn_str(), open=False, kwargs={"row_factory": dict_row}
+        conninfo=get_conn_str(),
+        open=False,
+        min_size=POSTGRES_POOL_MIN,
+        max_size=POSTGRES_POOL_MAX,
+        kwargs={"row_factory": dict_row, "autocommit": True},
     )
-    await app.pool.open()
+    await app.pool.open(wait=True, timeout=POSTGRES_POOL_TIMEOUT)
+    app.metrics = CollectorRegistry()
+    app.metrics.register(PoolCollector("db_pool", app.pool))
+    app.cache = get_cache()
+    await prewarm(app.cache, REDIS_POOL_MIN)
+    app.broadcaster = Broadcaster(app.cache)
+    await app.broadcaster.start()
     yield
+    await app.broadcaster.stop()
+    await app.cache.aclose(close_connection_pool=True)
     await app.pool.close()
 
 
-cache = redis.Redis(decode_responses=True)
-
 ROOT_PATH = "/api"
 
+# htmx stops polling an element when a response comes back with this status.
+HTMX_STOP_POLLING = 286
+
 app = FastAPI(root_path=ROOT_PATH, lifespan=lifespan)
 
-app.mount("/static", StaticFiles(directory="static"), name="static")
+app.mount("/static", PrecompressedStaticFiles(directory="static"), name="static")
+app.add_middleware(
+    CompressionMiddleware,
+    minimum_size=int(os.getenv("GZIP_MINIMUM_SIZE", 1024)),
+    exclude=("/static", "/task/stream"),
+)
+if PROFILING:
+    app.add_middleware(
+        ProfilingMiddleware, spans=PROFILE_SPANS, sample_rate=PROFILE_SAMPLE_RATE
+    )
+app.add_middleware(MetricsMiddleware)
 app.include_router(open_routes)
 app.include_router(protected_routes)
 app.include_router(user_routes)
@@ -58,19 +143,81 @@ app.state.limiter = limiter
 app.add_exception_handler(RateLimitExceeded, _rate_limit_exceeded_handler)
 
 templates = Jinja2Templates(directory="templates")
+if PROFILING:
+    templates.env.template_class = TimedTemplate
+templates.env.globals["asset"] = asset
+
+progressFragment = Fragment(templates.get_template("progress.html"), ("progress",))
+completeFragment = Fragment(
+    templates.get_template("complete.html"), ("id",), rootPath=ROOT_PATH
+)
+copycompleteFragment = Fragment(
+    templates.get_template("copycomplete.html"), ("id",), rootPath=ROOT_PATH
+)
+copyfailedFragment = Fragment(
+    templates.get_template("copyfailed.html"), ("id",), rootPath=ROOT_PATH
+)
+
+
+def notModified(request, tag):
+    header = request.headers.get("if-none-match")
+    if header is None:
+        return False
+    tags = [value.strip().removeprefix("W/") for value in header.split(",")]
+    return tag in tags or "*" in tags
+
+
+def conditional(request, tag, render):
+    headers = {"ETag": tag, "Cache-Control": "no-cache"}
+    if notModified(request, tag):
+        return Response(status_code=status.HTTP_304_NOT_MODIFIED, headers=headers)
+    return HTMLResponse(render(), headers=headers)
+
+
+def stopPolling():
+    return Response(status_code=HTMX_STOP_POLLING, headers={"HX-Reswap": "none"})
+
+
+def sse(event, data=""):
+    lines = "".join(f"data: {line}\n" for line in data.splitlines() or [""])
+    return f"event: {event}\n{lines}\n"
+
+
+# Rendered index pages keyed by base URL, dropped whenever the data they
+# show changes.
+indexCache = {"data": None, "pages": {}}
+
+
+def cachedIndex(request):
+    data = json.dumps([sampletasks, sampleusers, samplefiles])
+    if data != indexCache["data"] or len(indexCache["pages"]) > 16:
+        indexCache["data"] = data
+        indexCache["pages"] = {}
+    key = str(request.base_url)
+    page = indexCache["pages"].get(key)
+    if page is None:
+        context = {
+            "request": request,
+            "rootPath": ROOT_PATH,
+            "tasks": sampletasks,
+            "users": sampleusers,
+            "files": samplefiles,
+        }
+        body = templates.get_template("index.html").render(context).encode()
+        page = (body, gzip.compress(body))
+        indexCache["pages"][key] = page
+    return page
 
 
 @app.get("/", response_class=HTMLResponse)
-@limiter.limit("1/second")
+@limiter.limit(rate("index"))
 async def index(request: Request, hx_request: Optional[str] = Header(None)):
-    context = {
-        "request": request,
-        "rootPath": ROOT_PATH,
-        "tasks": sampletasks,
-        "users": sampleusers,
-        "files": samplefiles,
-    }
-    return templates.TemplateResponse("index.html", context)
+    body, compressed = cachedIndex(request)
+    headers = {"Vary": "Accept-Encoding"}
+    if "gzip" in request.headers.get("accept-encoding", ""):
+        headers["Content-Encoding"] = "gzip"
+        return HTMLResponse(compressed, headers=headers)
+    return HTMLResponse(body, headers=headers)
 
 
 @app.post("/start/{id}")
@@ -80,7 +227,7 @@ async def start(
     id: str,
     hx_request: Optional[str] = Header(None),
 ):
-    cache.set(f"progress_{id}", 0)
+    await request.app.cache.set(jobKey(id), 0)
     context = {"request": request, "rootPath": ROOT_PATH, "id": id}
     return templates.TemplateResponse("running.html", context)
 
@@ -93,14 +240,83 @@ class Data(BaseModel):
 async def copy(request: Request, data: Data, response: Response):
     response.status_code = status.HTTP_200_OK
     filename = data.filename
-    res = copyFile.delay(filename)
-    id = res.task_id
-    progress = {"transferred": 0, "total": 0}
-    cache.set(id, json.dumps(progress))
+    cache = request.app.cache
+    # A file that is already being copied gets the existing task's id, so
+    # this request follows its progress instead of starting another copy.
+    id = taskId()
+    owner = await claimCopy(cache, filename, id)
+    if owner == id:
+        await setProgress(cache, id)
+        try:
+            sendTask(COPY_FILE, (filename,), task_id=id)
+        except Exception:
+            await releaseCopy(cache, filename, id)
+            raise
+    id = owner
     context = {"request": request, "rootPath": ROOT_PATH, "id": id}
     return templates.TemplateResponse("copying.html", context)
 
 
+class BulkData(BaseModel):
+    filenames: list[str]
+
+    @field_validator("filenames", mode="before")
+    @classmethod
+    def listify(cls, value):
+        return [value] if isinstance(value, str) else value
+
+
+async def sendClaimed(request, tasks):
+    # Record every row before dispatch so a fast task can't delete its row
+    # before it exists.
+    await insertMany(
+        request.app.pool, [(task["id"], task["filename"]) for task in tasks]
+    )
+    pipe = request.app.cache.pipeline(transaction=False)
+    for task in tasks:
+        setProgress(pipe, task["id"])
+    await pipe.execute()
+    sendTasks(
+        COPY_FILE,
+        [(task["id"], (task["filename"],), {"recorded": True}) for task in tasks],
+    )
+
+
+@app.post("/copy/bulk")
+async def copybulk(request: Request, data: BulkData, response: Response):
+    response.status_code = status.HTTP_200_OK
+    filenames = dict.fromkeys(data.filenames)
+    tasks = [{"id": taskId(), "filename": filename} for filename in filenames]
+    if not tasks:
+        context = {"request": request, "rootPath": ROOT_PATH, "inprogress": []}
+        return templates.TemplateResponse("inprogress.html", context)
+    # Files already being copied are shown with their existing task, as in
+    # /copy, and only the rest are sent.
+    pipe = request.app.cache.pipeline(transaction=False)
+    for task in tasks:
+        await claimCopy(pipe, task["filename"], task["id"])
+    owners = await pipe.execute()
+    claimed = [task for task, owner in zip(tasks, owners) if owner == task["id"]]
+    for task, owner in zip(tasks, owners):
+        task["id"] = owner
+    if claimed:
+        try:
+            await sendClaimed(request, claimed)
+        except Exception:
+            # Nothing will run these tasks, so end them for the page and the
+            # task list as well as freeing their files.
+            pipe = request.app.cache.pipeline(transaction=False)
+            for task in claimed:
+                await releaseCopy(pipe, task["filename"], task["id"])
+                failProgress(pipe, task["id"])
+            await pipe.execute()
+            for task in claimed:
+                await finishAsync(request.app.pool, task["id"], "failed")
+            raise
+    context = {"request": request, "rootPath": ROOT_PATH, "inprogress": tasks}
+    return templates.TemplateResponse("inprogress.html", context)
+
+
 @app.get("/job/progress/{id}")
 async def job(
     request: Request,
@@ -108,47 +324,99 @@ async def job(
     id: str,
     hx_request: Optional[str] = Header(None),
 ):
-    current = cache.get(f"progress_{id}")
-    progress = int(current)
-    if progress < 100:
-        progress = progress + 10
-        cache.set(f"progress_{id}", progress)
-        context = {
-            "request": request,
-            "rootPath": ROOT_PATH,
-            "progress": progress,
-            "id": id,
-        }
-        return templates.TemplateResponse("progress.html", context)
-    if progress == 100:
-        context = {
-            "request": request,
-            "rootPath": ROOT_PATH,
-            "progress": progress,
-            "id": id,
-        }
-        response.headers["HX-Trigger"] = "done"
-        return templates.TemplateResponse(
-            "progress.html", context, headers=response.headers
-        )
+    result = await advanceJob(request.app.cache, id)
+    if result is None:
+        return stopPolling()
+    current, progress = result
+    if current < 100:
+        return HTMLResponse(progressFragment.render(progress=progress))
+    return HTMLResponse(
+        progressFragment.render(progress=progress),
+        status_code=HTMX_STOP_POLLING,
+        headers={"HX-Trigger": "done"},
+    )
 
 
 @app.get("/tasks")
 async def alltasks(
     request: Request,
     response: Response,
+    after_created: Optional[datetime] = None,
+    after_id: Optional[str] = None,
+    limit: int = Query(50, ge=1, le=500),
     hx_request: Optional[str] = Header(None),
 ):
-    results = await getTasks(request.app.pool)
+    after = None if after_created is None else (after_created, after_id or "")
+    results = await getTasks(request.app.pool, after=after, limit=limit)
+    next = None
+    if len(results) == limit:
+        last = results[-1]
+        next = urlencode(
+            {
+                "after_created": last["created"].isoformat(),
+                "after_id": last["id"],
+                "limit": limit,
+            }
+        )
     context = {
         "request": request,
         "rootPath": ROOT_PATH,
         "inprogress": results,
+        "next": next,
     }
     print(results)
     return templates.TemplateResponse("inprogress.html", context)
 
 
+@app.get("/tasks/progress")
+async def tasksprogress(
+    request: Request,
+    id: list[str] = Query([]),
+    hx_request: Optional[str] = Header(None),
+):
+    # One round trip for every bar in the in-progress list, swapped in
+    # out-of-band.
+    values = []
+    if id:
+        pipe = request.app.cache.pipeline(transaction=False)
+        for task_id in id:
+            readProgress(pipe, task_id)
+        values = await pipe.execute()
+    results = [
+        {"id": task_id, "progress": progress}
+        for task_id, progress in zip(id, map(parseProgress, values))
+        if progress is not None
+    ]
+    ids = [
+        result["id"]
+        for result in results
+        if result["progress"] != FAILED and result["progress"] < 100
+    ]
+    if not ids and not results:
+        return stopPolling()
+    context = {
+        "request": request,
+        "rootPath": ROOT_PATH,
+        "results": results,
+        "ids": ids,
+    }
+    if not ids:
+        # Every task has finished or failed: swap in the final states and
+        # stop polling.
+        return HTMLResponse(
+            templates.get_template("progressbatch.html").render(context),
+            status_code=HTMX_STOP_POLLING,
+        )
+    digest = hashlib.blake2b(digest_size=8)
+    for result in results:
+        digest.update(f"{result['id']}:{result['progress']};".encode())
+    return conditional(
+        request,
+        f'"{digest.hexdigest()}"',
+        lambda: templates.get_template("progressbatch.html").render(context),
+    )
+
+
 @app.get("/task/progress/{id}")
 async def task(
     request: Request,
@@ -156,29 +424,60 @@ async def task(
     id: str,
     hx_request: Optional[str] = Header(None),
 ):
-    result = cache.get(id)
-    data = json.loads(result)
-    transferred, total = data.values()
-    progress = 0 if total == 0 else round((transferred / total) * 100)
+    progress = parseProgress(await readProgress(request.app.cache, id))
+    if progress is None:
+        return stopPolling()
+    if progress == FAILED:
+        return Response(
+            status_code=HTMX_STOP_POLLING,
+            headers={"HX-Reswap": "none", "HX-Trigger": "done"},
+        )
     if progress < 100:
-        context = {
-            "request": request,
-            "rootPath": ROOT_PATH,
-            "progress": progress,
-            "id": id,
-        }
-        return templates.TemplateResponse("progress.html", context)
-    if progress == 100:
-        context = {
-            "request": request,
-            "rootPath": ROOT_PATH,
-            "progress": progress,
-            "id": id,
-        }
-        response.headers["HX-Trigger"] = "done"
-        return templates.TemplateResponse(
-            "progress.html", context, headers=response.headers
+        return conditional(
+            request,
+            f'"{progress}"',
+            lambda: progressFragment.render(progress=progress),
         )
+    return HTMLResponse(
+        progressFragment.render(progress=progress),
+        status_code=HTMX_STOP_POLLING,
+        headers={"HX-Trigger": "done"},
+    )
+
+
+@app.get("/task/stream/{id}")
+async def taskstream(request: Request, id: str):
+    async def events():
+        last = None
+        async with request.app.broadcaster.subscribe(id) as queue:
+            # Read the current value only after subscribing so no update
+            # published in between is missed.
+            progress = parseProgress(await readProgress(request.app.cache, id))
+            while True:
+                # A failed copy ends the stream the same way, and /task/{id}
+                # then shows that it failed. So does a missing entry, which
+                # has expired or was never set, as nothing will update it.
+                if progress is None or progress == FAILED:
+                    yield sse("done")
+                    return
+                if progress != last:
+                    last = progress
+                    html = progressFragment.render(progress=progress)
+                    yield sse("progress", html.decode())
+                if progress == 100:
+                    yield sse("done")
+                    return
+                try:
+                    message = await asyncio.wait_for(queue.get(), SSE_KEEPALIVE)
+                    progress = FAILED if message == FAILED else int(message)
+                except asyncio.TimeoutError:
+                    yield ": keepalive\n\n"
+                    # Re-read in case an update was lost, e.g. while the
+                    # listener was reconnecting.
+                    progress = parseProgress(await readProgress(request.app.cache, id))
+
+    headers = {"Cache-Control": "no-cache", "X-Accel-Buffering": "no"}
+    return StreamingResponse(events(), media_type="text/event-stream", headers=headers)
 
 
 @app.get("/job/{id}")
@@ -188,8 +487,7 @@ async def job(
     id: str,
     hx_request: Optional[str] = Header(None),
 ):
-    context = {"request": request, "rootPath": ROOT_PATH, "id": id}
-    return templates.TemplateResponse("complete.html", context)
+    return HTMLResponse(completeFragment.render(id=id))
 
 
 @app.get("/task/{id}")
@@ -199,18 +497,28 @@ async def task(
     id: str,
     hx_request: Optional[str] = Header(None),
 ):
-    context = {"request": request, "rootPath": ROOT_PATH, "id": id}
-    return templates.TemplateResponse("copycomplete.html", context)
+    progress = parseProgress(await readProgress(request.app.cache, id))
+    if progress == FAILED:
+        return HTMLResponse(copyfailedFragment.render(id=id))
+    return HTMLResponse(copycompleteFragment.render(id=id))
+
+
+@app.get("/metrics")
+async def metrics(request: Request):
+    # Pool stats belong to this process; everything else is merged across
+    # workers when PROMETHEUS_MULTIPROC_DIR is set.
+    body, content_type = exposition(registry(), request.app.metrics)
+    return Response(body, media_type=content_type)
 
 
 @app.post("/post")
-@limiter.limit("1/second")
+@limiter.limit(rate("post"))
 async def post(request: Request, data):
     return data
 
 
 @app.delete("/delete/{id}")
-@limiter.limit("1/second")
+@limiter.limit(rate("delete"))
 async def delete(request: Request, id: str, response: Response):
     response.status_code = status.HTTP_200_OK
     return response
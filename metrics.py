@@ -0,0 +1,143 @@
+import os
+import time
+
+from prometheus_client import (
+    CONTENT_TYPE_LATEST,
+    REGISTRY,
+    CollectorRegistry,
+    Counter,
+    Histogram,
+    generate_latest,
+    multiprocess,
+)
+from prometheus_client.core import GaugeMetricFamily
+import redis.asyncio as aioredis
+
+from profiling import span
+
+# With several processes (uvicorn --workers, celery prefork) each one writes
+# its samples under this directory and a scrape merges them.
+MULTIPROC = bool(os.getenv("PROMETHEUS_MULTIPROC_DIR"))
+
+LATENCY_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5)
+
+REQUEST_LATENCY = Histogram(
+    "http_request_duration_seconds",
+    "Time to serve a request, by route template.",
+    ["method", "route"],
+    buckets=LATENCY_BUCKETS,
+)
+REQUESTS = Counter(
+    "http_requests",
+    "Requests served, by route template and status.",
+    ["method", "route", "status"],
+)
+REDIS_LATENCY = Histogram(
+    "redis_command_duration_seconds",
+    "Round trip of a Redis command from the web app.",
+    ["command"],
+    buckets=LATENCY_BUCKETS,
+)
+
+
+def registry():
+    if MULTIPROC:
+        merged = CollectorRegistry()
+        multiprocess.MultiProcessCollector(merged)
+        return merged
+    return REGISTRY
+
+
+def exposition(*registries):
+    return b"".join(generate_latest(r) for r in registries), CONTENT_TYPE_LATEST
+
+
+class PoolCollector:
+    """Reports psycopg pool stats (size, available, waiting, cumulative wait
+    and usage times) when scraped, so the request path pays nothing."""
+
+    def __init__(self, name, pool):
+        self.name = name
+        self.pool = pool
+
+    def collect(self):
+        family = GaugeMetricFamily(
+            self.name, "psycopg connection pool stats.", labels=["stat"]
+        )
+        for stat, value in self.pool.get_stats().items():
+            family.add_metric([stat], value)
+        yield family
+
+
+class QueueCollector:
+    """Messages waiting in each Celery queue, read from the broker when
+    scraped."""
+
+    def __init__(self, app, queues):
+        self.app = app
+        self.queues = queues
+
+    def collect(self):
+        family = GaugeMetricFamily(
+            "celery_queue_length", "Messages waiting in the queue.", labels=["queue"]
+        )
+        with self.app.connection_for_read() as conn:
+            for queue in self.queues:
+                try:
+                    _, length, _ = conn.default_channel.queue_declare(
+                        queue, passive=True
+                    )
+                except Exception:
+                    length = 0
+                family.add_metric([queue], length)
+        yield family
+
+
+class TimedRedis(aioredis.Redis):
+    """Records the latency of every command sent outside a pipeline."""
+
+    async def execute_command(self, *args, **options):
+        start = time.perf_counter()
+        try:
+            with span("redis"):
+                return await super().execute_command(*args, **options)
+        finally:
+            REDIS_LATENCY.labels(args[0]).observe(time.perf_counter() - start)
+
+
+class MetricsMiddleware:
+    """Times each HTTP request and counts it by status, labelled with the
+    matched route template rather than the raw path."""
+
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+        status = 500
+
+        async def sendWithStatus(message):
+            nonlocal status
+            if message["type"] == "http.response.start":
+                status = message["status"]
+            await send(message)
+
+        start = time.perf_counter()
+        try:
+            await self.app(scope, receive, sendWithStatus)
+        finally:
+            elapsed = time.perf_counter() - start
+            route = scope.get("route")
+            if route is not None:
+                path = route.path
+            elif "endpoint" in scope:
+                # Mounted apps such as /static don't set a route.
+                root = scope.get("app_root_path", "")
+                path = scope["root_path"].removeprefix(root) + "/*"
+            else:
+                path = "unmatched"
+            method = scope["method"]
+            REQUEST_LATENCY.labels(method, path).observe(elapsed)
+            REQUESTS.labels(method, path, status).inc()
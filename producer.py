@@ -0,0 +1,53 @@
+import os
+from uuid import uuid4
+
+CELERY_BROKER_URL = os.getenv("CELERY_BROKER_URL")
+# copyFile is acked late, so the Redis broker hands a task that has been
+# unacked this long to another worker. Keep it above the longest transfer.
+CELERY_VISIBILITY_TIMEOUT = int(os.getenv("CELERY_VISIBILITY_TIMEOUT", 12 * 3600))
+
+COPY_FILE = "tasks.copyFile"
+
+# copyFile is sent to the small queue; workers forward files of at least
+# LARGE_FILE_THRESHOLD bytes to the large one, so each can be given its own
+# worker concurrency.
+QUEUE_SMALL = "copy_small"
+QUEUE_LARGE = "copy_large"
+
+celery = None
+
+
+def getCelery():
+    # A bare app that only publishes tasks by name, so the web process never
+    # imports tasks.py and its SSH and worker dependencies. Celery itself is
+    # imported on the first send rather than at startup.
+    global celery
+    if celery is None:
+        from celery import Celery
+
+        celery = Celery(
+            "tasks",
+            broker=CELERY_BROKER_URL,
+            broker_connection_retry_on_startup=True,
+            task_default_queue=QUEUE_SMALL,
+            broker_transport_options={"visibility_timeout": CELERY_VISIBILITY_TIMEOUT},
+        )
+    return celery
+
+
+def taskId():
+    return str(uuid4())
+
+
+def sendTask(name, args=(), kwargs=None, task_id=None):
+    task_id = task_id or taskId()
+    getCelery().send_task(name, args, kwargs, task_id=task_id)
+    return task_id
+
+
+def sendTasks(name, calls):
+    # Publishes (task_id, args, kwargs) calls over one broker connection.
+    app = getCelery()
+    with app.producer_or_acquire() as producer:
+        for task_id, args, kwargs in calls:
+            app.send_task(name, args, kwargs, task_id=task_id, producer=producer)
@@ -0,0 +1,155 @@
+import asyncio
+from contextlib import nullcontext
+from contextvars import ContextVar
+from functools import wraps
+import inspect
+import os
+import random
+import time
+
+import jinja2
+
+PROFILE_SPANS = os.getenv("PROFILE_SPANS", "").lower() in ("1", "true", "yes")
+PROFILE_SAMPLE_RATE = float(os.getenv("PROFILE_SAMPLE_RATE", 0))
+PROFILE_DIR = os.getenv("PROFILE_DIR", "profiles")
+ENABLED = PROFILE_SPANS or PROFILE_SAMPLE_RATE > 0
+
+# Durations by span name for the request or task being recorded, or None
+# when nothing is recording, which keeps span() to a single lookup.
+current = ContextVar("spans", default=None)
+disabled = nullcontext()
+
+
+class Span:
+    def __init__(self, spans, name):
+        self.spans = spans
+        self.name = name
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+
+    def __exit__(self, *exc):
+        elapsed = time.perf_counter() - self.start
+        total, count = self.spans.get(self.name, (0, 0))
+        self.spans[self.name] = (total + elapsed, count + 1)
+
+
+def span(name):
+    spans = current.get()
+    if spans is None:
+        return disabled
+    return Span(spans, name)
+
+
+def timed(name):
+    """Runs each call of the decorated function inside span(name). Returns
+    the function untouched when profiling is disabled."""
+
+    def decorate(fn):
+        if not ENABLED:
+            return fn
+        if inspect.iscoroutinefunction(fn):
+
+            @wraps(fn)
+            async def wrapper(*args, **kwargs):
+                with span(name):
+                    return await fn(*args, **kwargs)
+
+        else:
+
+            @wraps(fn)
+            def wrapper(*args, **kwargs):
+                with span(name):
+                    return fn(*args, **kwargs)
+
+        return wrapper
+
+    return decorate
+
+
+def serverTiming(spans):
+    return ", ".join(
+        f'{name};dur={total * 1000:.2f};desc="{count}x"'
+        for name, (total, count) in spans.items()
+    )
+
+
+def traced(name):
+    """Records the spans of each call and prints them when it returns.
+    Without PROFILE_SPANS the function is returned untouched."""
+
+    def decorate(fn):
+        if not PROFILE_SPANS:
+            return fn
+
+        @wraps(fn)
+        def wrapper(*args, **kwargs):
+            spans = {}
+            token = current.set(spans)
+            try:
+                with Span(spans, "total"):
+                    return fn(*args, **kwargs)
+            finally:
+                current.reset(token)
+                print(f"{name} {serverTiming(spans)}")
+
+        return wrapper
+
+    return decorate
+
+
+def saveProfile(profiler, label):
+    os.makedirs(PROFILE_DIR, exist_ok=True)
+    stamp = time.strftime("%Y%m%dT%H%M%S")
+    suffix = f"{os.getpid()}-{random.getrandbits(32):08x}"
+    path = os.path.join(PROFILE_DIR, f"{stamp}-{label}-{suffix}.html")
+    with open(path, "w") as f:
+        f.write(profiler.output_html())
+
+
+class ProfilingMiddleware:
+    """Records spans for every request into a Server-Timing header, and
+    runs a sampled fraction of requests under pyinstrument, saving each
+    profile to PROFILE_DIR. Only installed when either is enabled."""
+
+    def __init__(self, app, spans=True, sample_rate=0.0):
+        self.app = app
+        self.spans = spans
+        self.sample_rate = sample_rate
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+        spans = {}
+        token = current.set(spans)
+        start = time.perf_counter()
+
+        async def sendWithTiming(message):
+            if message["type"] == "http.response.start" and self.spans:
+                spans["total"] = (time.perf_counter() - start, 1)
+                headers = list(message.get("headers", []))
+                headers.append((b"server-timing", serverTiming(spans).encode()))
+                message = {**message, "headers": headers}
+            await send(message)
+
+        profiler = None
+        if self.sample_rate and random.random() < self.sample_rate:
+            from pyinstrument import Profiler
+
+            profiler = Profiler(async_mode="enabled")
+            profiler.start()
+        try:
+            await self.app(scope, receive, sendWithTiming)
+        finally:
+            current.reset(token)
+            if profiler is not None:
+                profiler.stop()
+                label = f"{scope['method']}{scope['path']}".replace("/", "_")
+                await asyncio.to_thread(saveProfile, profiler, label[:80])
+
+
+class TimedTemplate(jinja2.Template):
+    def render(self, *args, **kwargs):
+        with span("jinja"):
+            return super().render(*args, **kwargs)
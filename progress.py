@@ -0,0 +1,81 @@
+from broadcast import channel
+
+# Copy progress lives in a hash per task under a versioned key. Bump the
+# version whenever the fields change so old entries are ignored rather
+# than misread.
+PROGRESS_VERSION = 1
+PROGRESS_PREFIX = f"progress:v{PROGRESS_VERSION}:"
+FIELDS = ("transferred", "total", "failed")
+
+# What parseProgress returns, and subscribers receive, once a copy has
+# failed for good.
+FAILED = "failed"
+
+# Advances the demo job counter by ARGV[1], stopping at 100, and returns
+# the value before and after. Missing keys are left alone.
+ADVANCE_JOB = """
+local current = redis.call('GET', KEYS[1])
+if not current then
+    return nil
+end
+current = tonumber(current)
+local progress = current
+if current < 100 then
+    progress = math.min(current + tonumber(ARGV[1]), 100)
+    redis.call('SET', KEYS[1], progress)
+end
+return {current, progress}
+"""
+
+
+def progressKey(id):
+    return f"{PROGRESS_PREFIX}{id}"
+
+
+def jobKey(id):
+    return f"progress_{id}"
+
+
+def percent(transferred, total):
+    return 0 if total == 0 else round(transferred * 100 / total)
+
+
+# The helpers below only issue commands, so they work the same on sync and
+# async clients and on pipelines; await or execute as the client requires.
+
+
+def setProgress(client, id, transferred=0, total=0):
+    return client.hset(
+        progressKey(id), mapping={"transferred": transferred, "total": total}
+    )
+
+
+def publishProgress(pipe, id, transferred, total):
+    # Queues the update and its notification on a pipeline. Subscribers only
+    # draw the bar, so they get the percentage alone.
+    setProgress(pipe, id, transferred, total)
+    return pipe.publish(channel(id), percent(transferred, total))
+
+
+def failProgress(pipe, id):
+    pipe.hset(progressKey(id), "failed", 1)
+    return pipe.publish(channel(id), FAILED)
+
+
+def readProgress(client, id):
+    return client.hmget(progressKey(id), FIELDS)
+
+
+def parseProgress(values):
+    # Percentage from a readProgress reply, FAILED, or None if there is no
+    # entry.
+    transferred, total, failed = values
+    if failed:
+        return FAILED
+    if transferred is None or total is None:
+        return None
+    return percent(int(transferred), int(total))
+
+
+def advanceJob(client, id, step=10):
+    return client.register_script(ADVANCE_JOB)(keys=[jobKey(id)], args=[step])
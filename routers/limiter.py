@@ -1,4 +1,169 @@
+import os
+import threading
+import time
+
+from limits.storage import RedisStorage
 from slowapi import Limiter
 from slowapi.util import get_remote_address
 
-limiter = Limiter(key_func=get_remote_address)
+from profiling import span
+
+REDIS_URL = os.getenv("REDIS_URL", "redis://localhost:6379/0")
+RATE_LIMIT_STORAGE = os.getenv("RATE_LIMIT_STORAGE", f"cached+{REDIS_URL}")
+RATE_LIMIT_SYNC_INTERVAL = float(os.getenv("RATE_LIMIT_SYNC_INTERVAL", 0.1))
+REDIS_SOCKET_TIMEOUT = float(os.getenv("REDIS_SOCKET_TIMEOUT", 2))
+
+
+def rate(name, default="1/second"):
+    return os.getenv(f"RATE_LIMIT_{name.upper()}", default)
+
+
+# Adds ARGV[2] hits to a sliding window, shifting the current window to the
+# previous one first if it has expired, the way limits' own scripts do, and
+# returns both counts and their TTLs in milliseconds.
+SYNC_WINDOW = """
+local expiry = tonumber(ARGV[1]) * 1000
+local amount = tonumber(ARGV[2])
+local current_ttl = tonumber(redis.call('pttl', KEYS[2]))
+if current_ttl > 0 and current_ttl < expiry then
+    redis.call('rename', KEYS[2], KEYS[1])
+    redis.call('set', KEYS[2], 0, 'PX', current_ttl + expiry)
+end
+if amount > 0 then
+    if redis.call('exists', KEYS[2]) == 1 then
+        redis.call('incrby', KEYS[2], amount)
+    else
+        redis.call('set', KEYS[2], amount, 'PX', expiry * 2)
+    end
+end
+return {
+    redis.call('get', KEYS[1]), redis.call('pttl', KEYS[1]),
+    redis.call('get', KEYS[2]), redis.call('pttl', KEYS[2]),
+}
+"""
+
+
+class Window:
+    # A key's sliding window as Redis last reported it, plus the hits
+    # allowed here since then.
+
+    def __init__(self, expiry):
+        self.expiry = expiry
+        self.previous = self.current = self.pending = 0
+        self.previousTtl = self.currentTtl = 0.0
+        self.synced = self.used = time.monotonic()
+
+    def count(self, now):
+        # Weighted count as of now, moving the current window to the
+        # previous one if it has expired since the last sync.
+        elapsed = now - self.synced
+        previous, previousTtl = self.previous, self.previousTtl - elapsed
+        current, currentTtl = self.current, self.currentTtl - elapsed
+        if 0 < currentTtl < self.expiry:
+            previous, previousTtl, current = current, currentTtl, 0
+        weighted = previous * max(0.0, previousTtl) // self.expiry
+        return weighted + current + self.pending
+
+
+class CachedRedisStorage(RedisStorage):
+    """Sliding-window counters kept in each process and synced with Redis in
+    batches. Checks are answered from the local copy without a round trip;
+    a background thread sends the hits allowed since the last sync every
+    RATE_LIMIT_SYNC_INTERVAL seconds and reads back the totals from all
+    processes. A client can therefore go over its limit by whatever the
+    other processes allow it within one interval, or before a process has
+    first synced its key."""
+
+    STORAGE_SCHEME = ["cached+redis", "cached+rediss", "cached+redis+unix"]
+
+    def __init__(self, uri, **options):
+        super().__init__(uri.removeprefix("cached+"), **options)
+        self.lua_sync_window = self.get_connection().register_script(SYNC_WINDOW)
+        self.windows = {}
+        self.lock = threading.Lock()
+        self.syncer = None
+
+    def acquire_sliding_window_entry(self, key, limit, expiry, amount=1):
+        if self.syncer is None:
+            self.syncer = threading.Thread(target=self.syncLoop, daemon=True)
+            self.syncer.start()
+        now = time.monotonic()
+        with self.lock:
+            window = self.windows.setdefault(key, Window(expiry))
+            window.used = now
+            if amount > limit or window.count(now) + amount > limit:
+                return False
+            window.pending += amount
+            return True
+
+    def syncLoop(self):
+        while True:
+            time.sleep(RATE_LIMIT_SYNC_INTERVAL)
+            try:
+                self.sync()
+            except Exception as error:
+                print(f"Rate limit sync failed: {error}")
+
+    def sync(self):
+        # Windows idle for two periods have no weight left and are dropped.
+        now = time.monotonic()
+        with self.lock:
+            self.windows = {
+                key: window
+                for key, window in self.windows.items()
+                if window.pending or now - window.used <= 2 * window.expiry
+            }
+            batch = [
+                (key, window, window.pending) for key, window in self.windows.items()
+            ]
+            for _, window, _ in batch:
+                window.pending = 0
+        if not batch:
+            return
+        pipe = self.get_connection().pipeline(transaction=False)
+        for key, window, amount in batch:
+            keys = [
+                self.prefixed_key(self._previous_window_key(key)),
+                self.prefixed_key(self._current_window_key(key)),
+            ]
+            self.lua_sync_window(keys=keys, args=[window.expiry, amount], client=pipe)
+        try:
+            results = pipe.execute()
+        except Exception:
+            # Keep the hits for the next attempt.
+            with self.lock:
+                for _, window, amount in batch:
+                    window.pending += amount
+            raise
+        with self.lock:
+            for (_, window, _), result in zip(batch, results):
+                previous, previousTtl, current, currentTtl = result
+                window.previous = int(previous or 0)
+                window.previousTtl = max(0, int(previousTtl or 0)) / 1000
+                window.current = int(current or 0)
+                window.currentTtl = max(0, int(currentTtl or 0)) / 1000
+                window.synced = now
+
+
+class TimedLimiter(Limiter):
+    def _check_request_limit(self, *args, **kwargs):
+        with span("ratelimit"):
+            return super()._check_request_limit(*args, **kwargs)
+
+
+# The key is the client address, which uvicorn takes from X-Forwarded-For
+# when run with --proxy-headers. slowapi checks limits synchronously inside
+# the async handlers, so the cached+ storage answers them locally and only
+# the sync thread talks to Redis; the timeouts bound how long a stalled
+# Redis holds up a sync. The in-memory fallback covers the plain redis://
+# storage while Redis is unreachable.
+limiter = TimedLimiter(
+    key_func=get_remote_address,
+    storage_uri=RATE_LIMIT_STORAGE,
+    storage_options={
+        "socket_timeout": REDIS_SOCKET_TIMEOUT,
+        "socket_connect_timeout": REDIS_SOCKET_TIMEOUT,
+    },
+    strategy="sliding-window-counter",
+    in_memory_fallback_enabled=True,
+)
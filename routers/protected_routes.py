@@ -1,11 +1,11 @@
 from fastapi import APIRouter, Request, Response, status
-from .limiter import limiter
+from .limiter import limiter, rate
 
 router = APIRouter(prefix="/protected")
 
 
 @router.get("/")
-@limiter.limit("1/second")
+@limiter.limit(rate("protected"))
 def get(request: Request, response: Response):
     response.status_code = status.HTTP_200_OK
     return "Hello, from protected!"
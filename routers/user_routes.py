@@ -1,12 +1,12 @@
 from fastapi import APIRouter, Request, Response, status
-from .limiter import limiter
+from .limiter import limiter, rate
 from utils import fruitname
 
 router = APIRouter(prefix="/user")
 
 
 @router.get("/")
-@limiter.limit("1/second")
+@limiter.limit(rate("user"))
 def get(request: Request, response: Response):
     response.status_code = status.HTTP_200_OK
     return f"Hello, {fruitname()}!"
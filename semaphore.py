@@ -0,0 +1,67 @@
+import random
+import time
+from uuid import uuid4
+
+# Holders live in a sorted set scored by when they last checked in, using
+# the Redis clock so workers don't need synchronised clocks. Holders that
+# stop checking in (a killed worker) expire after ttl seconds.
+ACQUIRE = """
+local time = redis.call('TIME')
+local now = tonumber(time[1]) + tonumber(time[2]) / 1000000
+local ttl = tonumber(ARGV[2])
+redis.call('ZREMRANGEBYSCORE', KEYS[1], '-inf', now - ttl)
+if redis.call('ZCARD', KEYS[1]) < tonumber(ARGV[1]) then
+    redis.call('ZADD', KEYS[1], now, ARGV[3])
+    redis.call('EXPIRE', KEYS[1], math.ceil(ttl))
+    return 1
+end
+return 0
+"""
+
+REFRESH = """
+if not redis.call('ZSCORE', KEYS[1], ARGV[2]) then
+    return 0
+end
+local time = redis.call('TIME')
+redis.call('ZADD', KEYS[1], tonumber(time[1]) + tonumber(time[2]) / 1000000, ARGV[2])
+redis.call('EXPIRE', KEYS[1], math.ceil(tonumber(ARGV[1])))
+return 1
+"""
+
+
+class Semaphore:
+    """A counting semaphore shared by every process using the same Redis
+    key. acquire() blocks until one of limit slots is free and returns a
+    token for it, which the holder must refresh() more often than every ttl
+    seconds and release() when done. SFTPPool takes a slot for each SSH
+    session it opens, refreshes the tokens of its open sessions from its
+    maintenance thread and releases them as sessions close."""
+
+    def __init__(self, client, key, limit, ttl=60, poll=0.25):
+        self.client = client
+        self.key = key
+        self.limit = limit
+        self.ttl = ttl
+        self.poll = poll
+        self.waitingKey = f"{key}:waiting"
+        self.acquireScript = client.register_script(ACQUIRE)
+        self.refreshScript = client.register_script(REFRESH)
+
+    def acquire(self):
+        token = uuid4().hex
+        while not self.acquireScript(
+            keys=[self.key], args=[self.limit, self.ttl, token]
+        ):
+            # Tells holders that are only idling to give their slots up.
+            self.client.set(self.waitingKey, 1, px=int(self.poll * 4000))
+            time.sleep(self.poll * random.uniform(0.5, 1.5))
+        return token
+
+    def contended(self):
+        return bool(self.client.exists(self.waitingKey))
+
+    def refresh(self, token):
+        return self.refreshScript(keys=[self.key], args=[self.ttl, token])
+
+    def release(self, token):
+        self.client.zrem(self.key, token)
@@ -0,0 +1,188 @@
+from contextlib import contextmanager
+import threading
+import time
+
+import paramiko
+
+from profiling import span
+
+
+class Session:
+    def __init__(self, transport, sftp, semaphore=None, token=None):
+        self.transport = transport
+        self.sftp = sftp
+        self.semaphore = semaphore
+        self.token = token
+        self.last_used = time.monotonic()
+        self.refreshed = self.last_used
+        self.closed = False
+
+    def close(self):
+        self.closed = True
+        try:
+            self.sftp.close()
+        finally:
+            self.transport.close()
+            if self.semaphore:
+                self.semaphore.release(self.token)
+
+
+class SFTPPool:
+    """Authenticated SFTP sessions kept open between tasks, keyed by host,
+    so a worker process only pays the SSH handshake once per host.
+
+    slots(host) may return a Semaphore that every open session to host,
+    busy or idle, holds a slot of until it is closed. Idle sessions give
+    their slots up as soon as another process is waiting for one."""
+
+    def __init__(
+        self,
+        username,
+        password,
+        port=22,
+        size=2,
+        idle_timeout=300,
+        check_interval=30,
+        slots=None,
+    ):
+        self.username = username
+        self.password = password
+        self.port = port
+        self.size = size
+        self.idle_timeout = idle_timeout
+        self.check_interval = check_interval
+        self.idle = {}
+        self.lock = threading.Lock()
+        self.slots = slots
+        self.semaphores = {}
+        self.open = set()
+        self.stopped = threading.Event()
+        if slots:
+            threading.Thread(target=self.maintain, daemon=True).start()
+
+    def semaphore(self, host):
+        with self.lock:
+            if host not in self.semaphores:
+                self.semaphores[host] = self.slots(host)
+            return self.semaphores[host]
+
+    def connect(self, host):
+        semaphore = self.semaphore(host) if self.slots else None
+        token = semaphore.acquire() if semaphore else None
+        transport = None
+        try:
+            with span("connect"):
+                transport = paramiko.Transport((host, self.port))
+            # Transport.connect split in two so each step can be timed.
+            with span("connect"):
+                transport.start_client()
+            with span("auth"):
+                transport.auth_password(self.username, self.password)
+            sftp = paramiko.SFTPClient.from_transport(transport)
+        except Exception:
+            if transport:
+                transport.close()
+            if semaphore:
+                semaphore.release(token)
+            raise
+        session = Session(transport, sftp, semaphore, token)
+        if semaphore:
+            with self.lock:
+                self.open.add(session)
+        return session
+
+    def maintain(self):
+        # Keeps the slots of open sessions alive, and closes idle sessions
+        # that time out or whose host another process is waiting on.
+        while not self.stopped.wait(1):
+            try:
+                self.evict()
+                with self.lock:
+                    self.open = {s for s in self.open if not s.closed}
+                    sessions = list(self.open)
+                    hosts = [host for host, idle in self.idle.items() if idle]
+                for host in hosts:
+                    if self.semaphore(host).contended():
+                        with self.lock:
+                            stale, self.idle[host] = self.idle[host], []
+                        for session in stale:
+                            session.close()
+                now = time.monotonic()
+                for session in sessions:
+                    if session.closed:
+                        continue
+                    if now - session.refreshed >= session.semaphore.ttl / 3:
+                        session.semaphore.refresh(session.token)
+                        session.refreshed = now
+            except Exception as error:
+                print(f"SFTP pool maintenance failed: {error}")
+
+    def healthy(self, session):
+        if not session.transport.is_active():
+            return False
+        if time.monotonic() - session.last_used < self.check_interval:
+            return True
+        try:
+            session.sftp.stat(".")
+            return True
+        except (paramiko.SSHException, EOFError, OSError):
+            return False
+
+    def evict(self):
+        now = time.monotonic()
+        with self.lock:
+            stale = []
+            for host, sessions in self.idle.items():
+                keep = []
+                for session in sessions:
+                    if now - session.last_used > self.idle_timeout:
+                        stale.append(session)
+                    else:
+                        keep.append(session)
+                self.idle[host] = keep
+        for session in stale:
+            session.close()
+
+    def acquire(self, host):
+        self.evict()
+        while True:
+            with self.lock:
+                sessions = self.idle.get(host)
+                session = sessions.pop() if sessions else None
+            if session is None:
+                return self.connect(host)
+            if self.healthy(session):
+                return session
+            session.close()
+
+    def release(self, host, session):
+        session.last_used = time.monotonic()
+        with self.lock:
+            sessions = self.idle.setdefault(host, [])
+            if len(sessions) < self.size:
+                sessions.append(session)
+                return
+        session.close()
+
+    @contextmanager
+    def session(self, host):
+        session = self.acquire(host)
+        try:
+            yield session.sftp
+        except Exception:
+            # A dead transport is dropped; errors such as a missing remote
+            # file leave the session usable.
+            if session.transport.is_active():
+                self.release(host, session)
+            else:
+                session.close()
+            raise
+        self.release(host, session)
+
+    def close(self):
+        self.stopped.set()
+        with self.lock:
+            sessions = [session for idle in self.idle.values() for session in idle]
+            self.idle = {}
+        for session in sessions:
+            session.close()
@@ -1,14 +1,39 @@
-import json
+from concurrent.futures import ThreadPoolExecutor
 import os
+import time
 
 from celery import Celery
-from celery.signals import worker_process_init, worker_process_shutdown
+from celery.concurrency import get_implementation
+from celery.concurrency.prefork import TaskPool
+from celery.signals import worker_init, worker_process_init, worker_process_shutdown
 from dotenv import load_dotenv
 import paramiko
+from prometheus_client import Counter, Gauge, Histogram, multiprocess, start_http_server
 from psycopg_pool import ConnectionPool
 import redis
 
-from db_ops import createTable, insert, delete
+from bandwidth import BANDWIDTH_SHAPING, Throttle
+from checksum import (
+    ChecksumMismatch,
+    StreamingHash,
+    localBlocks,
+    remoteBlocks,
+    remoteChecksum,
+)
+from db_ops import createTable, insert, finish
+from inflight import keepCopy, refreshCopy, releaseCopy
+from metrics import MULTIPROC, QueueCollector, registry
+from profiling import span, traced
+from producer import (
+    CELERY_VISIBILITY_TIMEOUT,
+    COPY_FILE,
+    QUEUE_LARGE,
+    QUEUE_SMALL,
+)
+from progress import failProgress, publishProgress
+from semaphore import Semaphore
+from sftp_pool import SFTPPool
+from transfer import changedPieces, deltaGet, parallelGet, splitRanges
 
 load_dotenv()
 
@@ -25,28 +50,104 @@ def get_conn_str():
 
 CELERY_BROKER_URL = os.getenv("CELERY_BROKER_URL")
 CELERY_RESULT_BACKEND = os.getenv("CELERY_RESULT_BACKEND")
+REDIS_URL = os.getenv("REDIS_URL", "redis://localhost:6379/0")
 SSH_USERNAME = os.getenv("SSH_USERNAME")
 SSH_PASSWORD = os.getenv("SSH_PASSWORD")
 REMOTE_HOST = os.getenv("REMOTE_HOST")
+REMOTE_PORT = int(os.getenv("REMOTE_PORT", 22))
 REMOTE_ROOT_PATH = os.getenv("REMOTE_ROOT_PATH")
 LOCAL_ROOT_PATH = os.getenv("LOCAL_ROOT_PATH")
+PROGRESS_INTERVAL = float(os.getenv("PROGRESS_INTERVAL", 0.5))
+PROGRESS_MIN_DELTA = float(os.getenv("PROGRESS_MIN_DELTA", 1))
+SFTP_POOL_SIZE = int(os.getenv("SFTP_POOL_SIZE", 2))
+SFTP_IDLE_TIMEOUT = float(os.getenv("SFTP_IDLE_TIMEOUT", 300))
+SFTP_CHECK_INTERVAL = float(os.getenv("SFTP_CHECK_INTERVAL", 30))
+SFTP_PARALLEL_RANGES = int(os.getenv("SFTP_PARALLEL_RANGES", 4))
+SFTP_PARALLEL_THRESHOLD = int(os.getenv("SFTP_PARALLEL_THRESHOLD", 64 * 1024 * 1024))
+WORKER_METRICS_PORT = int(os.getenv("WORKER_METRICS_PORT", 9808))
+LARGE_FILE_THRESHOLD = int(os.getenv("LARGE_FILE_THRESHOLD", 256 * 1024 * 1024))
+HOST_MAX_SESSIONS = int(os.getenv("HOST_MAX_SESSIONS", 8))
+HOST_SESSION_TTL = float(os.getenv("HOST_SESSION_TTL", 60))
+CHECKSUM_ALGORITHM = os.getenv("CHECKSUM_ALGORITHM", "sha256").lower()
+CHECKSUM_REMOTE = os.getenv("CHECKSUM_REMOTE", "true").lower() != "false"
+CHECKSUM_TIMEOUT = float(os.getenv("CHECKSUM_TIMEOUT", 600))
+SKIP_UNCHANGED = os.getenv("SKIP_UNCHANGED", "true").lower() != "false"
+DELTA_TRANSFER = os.getenv("DELTA_TRANSFER", "true").lower() != "false"
+DELTA_THRESHOLD = int(os.getenv("DELTA_THRESHOLD", 64 * 1024 * 1024))
+DELTA_BLOCK_SIZE = int(os.getenv("DELTA_BLOCK_SIZE", 1024 * 1024))
+DUPLICATE_RETRY_DELAY = float(os.getenv("DUPLICATE_RETRY_DELAY", 30))
 
 pool = None
+sftp_pool = None
+
+ACTIVE_TRANSFERS = Gauge(
+    "copy_active_transfers", "Transfers in progress.", multiprocess_mode="livesum"
+)
+TRANSFERRED_BYTES = Counter("copy_transferred_bytes", "Bytes copied from the remote.")
+TRANSFER_DURATION = Histogram(
+    "copy_duration_seconds",
+    "Time taken by each copyFile run, by outcome.",
+    ["status"],
+    buckets=(0.1, 0.5, 1, 5, 10, 30, 60, 300, 900, 3600),
+)
+TRANSFER_RATE = Histogram(
+    "copy_throughput_bytes_per_second",
+    "Average throughput of each completed transfer.",
+    buckets=(1e5, 1e6, 5e6, 1e7, 2.5e7, 5e7, 1e8, 2.5e8, 1e9),
+)
+WORKER_POOL = Gauge(
+    "worker_db_pool",
+    "psycopg connection pool stats per worker process.",
+    ["stat"],
+    multiprocess_mode="livesum",
+)
 
-cache = redis.Redis(decode_responses=True)
+cache = redis.Redis.from_url(REDIS_URL, decode_responses=True)
 
 celery = Celery(
     "tasks",
     broker=CELERY_BROKER_URL,
     backend=CELERY_RESULT_BACKEND,
     broker_connection_retry_on_startup=True,
+    task_default_queue=QUEUE_SMALL,
+    broker_transport_options={"visibility_timeout": CELERY_VISIBILITY_TIMEOUT},
+    # Transfers are long, so each process takes one message at a time.
+    worker_prefetch_multiplier=1,
 )
 
 
+@worker_init.connect
+def start_exporter(sender=None, **kwargs):
+    # Runs once in the parent process, which serves the samples of every
+    # child when PROMETHEUS_MULTIPROC_DIR is set. Prefork children record
+    # their transfers somewhere it can't see otherwise, so skip the exporter
+    # rather than export metrics that always read zero.
+    if not WORKER_METRICS_PORT:
+        return
+    if not MULTIPROC and get_implementation(sender.pool_cls) is TaskPool:
+        print(
+            "Worker metrics are off: set PROMETHEUS_MULTIPROC_DIR to an empty "
+            "directory for prefork workers to export them."
+        )
+        return
+    exporter = registry()
+    exporter.register(QueueCollector(celery, [QUEUE_SMALL, QUEUE_LARGE]))
+    start_http_server(WORKER_METRICS_PORT, registry=exporter)
+
+
 @worker_process_init.connect
 def init_worker(**kwargs):
-    global pool
-    pool = ConnectionPool(conninfo=get_conn_str())
+    global pool, sftp_pool
+    pool = ConnectionPool(conninfo=get_conn_str(), kwargs={"autocommit": True})
+    sftp_pool = SFTPPool(
+        SSH_USERNAME,
+        SSH_PASSWORD,
+        port=REMOTE_PORT,
+        size=SFTP_POOL_SIZE,
+        idle_timeout=SFTP_IDLE_TIMEOUT,
+        check_interval=SFTP_CHECK_INTERVAL,
+        slots=hostSlots if HOST_MAX_SESSIONS > 0 else None,
+    )
     try:
         createTable(pool)
         print("Creating tasks table")
@@ -54,34 +155,276 @@ def init_worker(**kwargs):
         print("Tasks table already exists")
 
 
-def updateProgress(id):
+def updateProgress(id, filename):
+    # paramiko calls back on every 32 KB chunk, so only report when enough
+    # time has passed and the percentage has moved, plus the first and final
+    # values. Each report also keeps this copy's claim on filename alive.
+    pipe = cache.pipeline(transaction=False)
+    last_time = None
+    last_percent = None
+    last_transferred = None
+
     def update(transferred, total):
-        cache.set(id, json.dumps({"transferred": transferred, "total": total}))
+        nonlocal last_time, last_percent, last_transferred
+        now = time.monotonic()
+        percent = 100 if total == 0 else transferred * 100 / total
+        if last_time is not None and transferred != total:
+            if now - last_time < PROGRESS_INTERVAL:
+                return
+            if percent - last_percent < PROGRESS_MIN_DELTA:
+                return
+        last_time = now
+        last_percent = percent
+        # The first report includes bytes resumed from a checkpoint.
+        if last_transferred is not None:
+            TRANSFERRED_BYTES.inc(transferred - last_transferred)
+        last_transferred = transferred
+        publishProgress(pipe, id, transferred, total)
+        refreshCopy(pipe, filename, id)
+        pipe.execute()
 
     return update
 
 
-@celery.task(bind=True)
-def copyFile(self, filename):
+def hostSlots(host):
+    # Every open SSH session to host, in use or pooled, holds one of
+    # HOST_MAX_SESSIONS slots shared by every worker.
+    return Semaphore(cache, f"sessions_{host}", HOST_MAX_SESSIONS, ttl=HOST_SESSION_TTL)
+
+
+def loadCheckpoint(filename, attrs, ranges, partpath):
+    # A checkpoint is only trusted if the remote file and the range split
+    # are unchanged and the partial file is still there.
+    key = f"checkpoint_{filename}"
+    fields = {"size": attrs.st_size, "mtime": attrs.st_mtime, "ranges": ranges}
+    saved = cache.hgetall(key)
+    if os.path.exists(partpath) and all(
+        saved.get(field) == str(value) for field, value in fields.items()
+    ):
+        return {
+            int(field.removeprefix("range_")): int(value)
+            for field, value in saved.items()
+            if field.startswith("range_")
+        }
+    pipe = cache.pipeline()
+    pipe.delete(key)
+    pipe.hset(key, mapping=fields)
+    pipe.execute()
+    return {}
+
+
+def saveCheckpoint(filename):
+    key = f"checkpoint_{filename}"
+
+    def save(start, committed):
+        cache.hset(key, f"range_{start}", committed)
+
+    return save
+
+
+def unchanged(attrs, path):
+    # Copies take the remote mtime, so a local file matching the remote size
+    # and mtime is taken to be a copy of it.
+    try:
+        local = os.stat(path)
+    except FileNotFoundError:
+        return False
+    return local.st_size == attrs.st_size and int(local.st_mtime) == attrs.st_mtime
+
+
+def deltaPieces(sftp, inpath, outpath, size):
+    # Blocks of the remote file that differ from the local copy, or None for
+    # a full transfer if there is no local copy or the remote host can't
+    # hash blocks. Both sides are hashed at the same time.
+    if not os.path.exists(outpath):
+        return None
+    with ThreadPoolExecutor(max_workers=1) as executor:
+        remote = executor.submit(
+            remoteBlocks, sftp, inpath, DELTA_BLOCK_SIZE, CHECKSUM_TIMEOUT
+        )
+        local = localBlocks(outpath, DELTA_BLOCK_SIZE)
+        remote = remote.result()
+    if remote is None or len(remote) != -(-size // DELTA_BLOCK_SIZE):
+        return None
+    return changedPieces(local, remote, size, DELTA_BLOCK_SIZE)
+
+
+RETRY_ERRORS = (paramiko.SSHException, EOFError, ConnectionError, ChecksumMismatch)
+
+
+@celery.task(
+    name=COPY_FILE,
+    bind=True,
+    acks_late=True,
+    reject_on_worker_lost=True,
+    autoretry_for=RETRY_ERRORS,
+    retry_backoff=True,
+    max_retries=5,
+)
+@traced("copyFile")
+def copyFile(self, filename, recorded=False):
     id = self.request.id
-    insert(pool, id, filename)
-    transport = paramiko.Transport((REMOTE_HOST, 22))
+    if not recorded or self.request.retries:
+        with span("db_insert"):
+            insert(pool, id, filename)
     inpath = f"{REMOTE_ROOT_PATH}/{filename}"
     outpath = f"{LOCAL_ROOT_PATH}/{filename}"
-    transport.connect(None, SSH_USERNAME, SSH_PASSWORD)
-    sftp = paramiko.SFTPClient.from_transport(transport)
-    sftp.get(
-        inpath,
-        outpath,
-        callback=updateProgress(id),
-    )
-    sftp.close()
-    transport.close()
-    delete(pool, id)
+    partpath = f"{outpath}.part"
+    checksum = verified = None
+    start = time.perf_counter()
+    keepalive = None
+    try:
+        ACTIVE_TRANSFERS.inc()
+        owner, keepalive = keepCopy(cache, filename, id)
+        if owner != id:
+            # Our claim lapsed while queued and another task now copies the
+            # file. Run again once it is done, when the file will usually be
+            # skipped as unchanged, rather than write the same part file.
+            print(f"{filename} is being copied by {owner}, retrying later")
+            queue = (self.request.delivery_info or {}).get("routing_key")
+            self.apply_async(
+                (filename,),
+                {"recorded": True},
+                task_id=id,
+                queue=queue,
+                countdown=DUPLICATE_RETRY_DELAY,
+            )
+            return
+        with sftp_pool.session(REMOTE_HOST) as sftp:
+            attrs = sftp.stat(inpath)
+            size = attrs.st_size
+            if SKIP_UNCHANGED and unchanged(attrs, outpath):
+                updateProgress(id, filename)(size, size)
+                with span("db_finish"):
+                    finish(pool, id, "skipped")
+                releaseCopy(cache, filename, id)
+                TRANSFER_DURATION.labels("skipped").observe(time.perf_counter() - start)
+                return
+            # The web app can't stat files, so large ones that arrive on the
+            # small queue are sent on to the large queue under the same id.
+            queue = (self.request.delivery_info or {}).get("routing_key")
+            if size >= LARGE_FILE_THRESHOLD and queue not in (None, QUEUE_LARGE):
+                self.apply_async(
+                    (filename,), {"recorded": True}, task_id=id, queue=QUEUE_LARGE
+                )
+                refreshCopy(cache, filename, id)
+                return
+            throttle = None
+            if BANDWIDTH_SHAPING:
+                priority = "large" if size >= LARGE_FILE_THRESHOLD else "small"
+                throttle = Throttle(cache, REMOTE_HOST, priority)
+            if SFTP_PARALLEL_RANGES > 1 and size >= SFTP_PARALLEL_THRESHOLD:
+                ranges = SFTP_PARALLEL_RANGES
+            else:
+                ranges = 1
+            offsets = loadCheckpoint(filename, attrs, ranges, partpath)
+            pieces = None
+            if DELTA_TRANSFER and not offsets and size >= DELTA_THRESHOLD:
+                with span("delta"):
+                    pieces = deltaPieces(sftp, inpath, outpath, size)
+            # Each range is hashed as it arrives and checked against the
+            # digest of the same range on the remote side; a delta copy is
+            # written in order, so it is a single range.
+            if pieces is None:
+                spans = splitRanges(size, ranges) or [(0, size)]
+            else:
+                spans = [(0, size)]
+            digest = None
+            if CHECKSUM_ALGORITHM != "none":
+                digest = StreamingHash(CHECKSUM_ALGORITHM, partpath, spans)
+                # Bytes kept from an earlier attempt are hashed from disk.
+                for start, committed in offsets.items():
+                    digest.readBack(start, start + committed)
+            # The remote side hashes its copy while the transfer runs.
+            executor = ThreadPoolExecutor(max_workers=1)
+            try:
+                pending = None
+                if digest and CHECKSUM_REMOTE:
+                    pending = executor.submit(
+                        remoteChecksum,
+                        sftp,
+                        inpath,
+                        CHECKSUM_ALGORITHM,
+                        spans,
+                        CHECKSUM_TIMEOUT,
+                    )
+                with span("transfer"):
+                    if pieces is not None:
+                        deltaGet(
+                            sftp,
+                            inpath,
+                            outpath,
+                            partpath,
+                            size,
+                            pieces,
+                            callback=updateProgress(id, filename),
+                            throttle=throttle,
+                            hasher=digest.update if digest else None,
+                        )
+                    else:
+                        parallelGet(
+                            sftp,
+                            inpath,
+                            partpath,
+                            size,
+                            ranges,
+                            callback=updateProgress(id, filename),
+                            offsets=offsets,
+                            checkpoint=saveCheckpoint(filename),
+                            throttle=throttle,
+                            hasher=digest.update if digest else None,
+                        )
+                with span("checksum"):
+                    if digest:
+                        checksum = ",".join(digest.hexdigests())
+                    remote = pending.result() if pending else None
+                    expected = ",".join(remote) if remote else None
+            finally:
+                executor.shutdown(wait=False, cancel_futures=True)
+        if expected is not None:
+            verified = checksum == expected
+        if verified is False:
+            # Start the retry from scratch rather than resume a bad file.
+            os.remove(partpath)
+            cache.delete(f"checkpoint_{filename}")
+            raise ChecksumMismatch(f"{inpath}: expected {expected}, got {checksum}")
+        os.utime(partpath, (attrs.st_atime, attrs.st_mtime))
+        os.replace(partpath, outpath)
+    except Exception as error:
+        # A retry marks the row active again when it re-inserts it.
+        with span("db_finish"):
+            finish(pool, id, "failed", checksum, verified)
+        # A task that will be retried keeps its claim on the file.
+        retried = isinstance(error, RETRY_ERRORS)
+        if not retried or self.request.retries >= self.max_retries:
+            pipe = cache.pipeline(transaction=False)
+            failProgress(pipe, id)
+            pipe.execute()
+            releaseCopy(cache, filename, id)
+        TRANSFER_DURATION.labels("failed").observe(time.perf_counter() - start)
+        raise
+    finally:
+        ACTIVE_TRANSFERS.dec()
+        if keepalive:
+            keepalive.set()
+        for stat, value in pool.get_stats().items():
+            WORKER_POOL.labels(stat).set(value)
+    cache.delete(f"checkpoint_{filename}")
+    with span("db_finish"):
+        finish(pool, id, checksum=checksum, verified=verified)
+    releaseCopy(cache, filename, id)
+    elapsed = time.perf_counter() - start
+    TRANSFER_DURATION.labels("complete").observe(elapsed)
+    if elapsed > 0:
+        TRANSFER_RATE.observe(size / elapsed)
 
 
 @worker_process_shutdown.connect
 def shutdown_worker(**kwargs):
-    global pool
+    global pool, sftp_pool
+    if MULTIPROC:
+        multiprocess.mark_process_dead(os.getpid())
+    if sftp_pool:
+        sftp_pool.close()
     if pool:
         pool.close()
@@ -0,0 +1,86 @@
+import os
+
+from transfer import changedPieces, deltaGet
+
+
+class RemoteFile:
+    def __init__(self, data):
+        self.data = data
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        pass
+
+    def readv(self, pieces, **kwargs):
+        return [self.data[offset : offset + length] for offset, length in pieces]
+
+
+class SFTP:
+    def __init__(self, data):
+        self.data = data
+
+    def open(self, path, mode):
+        return RemoteFile(self.data)
+
+
+def deltaCopy(tmp_path, local, remote, blockSize):
+    basepath = tmp_path / "file"
+    basepath.write_bytes(local)
+    outpath = tmp_path / "file.part"
+    pieces = changedPieces(
+        [local[i : i + blockSize] for i in range(0, len(local), blockSize)],
+        [remote[i : i + blockSize] for i in range(0, len(remote), blockSize)],
+        len(remote),
+        blockSize,
+    )
+    reports = []
+    deltaGet(
+        SFTP(remote),
+        "file",
+        basepath,
+        outpath,
+        len(remote),
+        pieces,
+        callback=lambda transferred, total: reports.append((transferred, total)),
+    )
+    return pieces, reports, outpath.read_bytes()
+
+
+def test_empty_delta_reports_complete(tmp_path):
+    data = os.urandom(10_000)
+    pieces, reports, copied = deltaCopy(tmp_path, data, data, 1024)
+    assert pieces == []
+    assert reports == [(10_000, 10_000)]
+    assert copied == data
+
+
+def test_delta_fetches_changed_blocks(tmp_path):
+    local = os.urandom(10_000)
+    remote = local[:2048] + b"x" * 10 + local[2058:9000]
+    pieces, reports, copied = deltaCopy(tmp_path, local, remote, 1024)
+    assert pieces == [(2048, 1024), (8192, 808)]
+    assert reports[0] == (9000 - 1024 - 808, 9000)
+    assert reports[-1] == (9000, 9000)
+    assert copied == remote
+
+
+def test_delta_hashes_in_order(tmp_path):
+    local = os.urandom(10_000)
+    remote = local[:2048] + b"x" * 10 + local[2058:9000]
+    basepath = tmp_path / "file"
+    basepath.write_bytes(local)
+    pieces = [(2048, 1024), (8192, 808)]
+    written = []
+    deltaGet(
+        SFTP(remote),
+        "file",
+        basepath,
+        tmp_path / "file.part",
+        len(remote),
+        pieces,
+        hasher=lambda offset, data: written.append((offset, data)),
+    )
+    assert [offset for offset, _ in written] == [0, 2048, 3072, 8192]
+    assert b"".join(data for _, data in written) == remote
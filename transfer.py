@@ -0,0 +1,162 @@
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import ExitStack
+import os
+import threading
+
+import paramiko
+
+PIECE_SIZE = 1024 * 1024
+MAX_REQUESTS = 64
+CHECKPOINT_SIZE = 16 * 1024 * 1024
+
+
+def splitRanges(size, count):
+    step = max(1, -(-size // count))
+    return [(start, min(step, size - start)) for start in range(0, size, step)]
+
+
+def parallelGet(
+    sftp,
+    inpath,
+    outpath,
+    size,
+    ranges,
+    callback=None,
+    offsets=None,
+    checkpoint=None,
+    throttle=None,
+    hasher=None,
+):
+    # Each range gets its own SFTP channel on the session's transport and
+    # pipelines its reads, writing straight to its offset in the local file.
+    # offsets maps a range's start to the bytes of it already on disk, and
+    # checkpoint(start, committed) is called once new data has been synced,
+    # throttle(length) after every read, blocking to pace the transfer, and
+    # hasher(offset, data) after every write.
+    offsets = offsets or {}
+    transport = sftp.get_channel().get_transport()
+    lock = threading.Lock()
+    failed = threading.Event()
+    transferred = sum(offsets.values())
+
+    with open(outpath, "r+b" if offsets else "wb") as f:
+        f.truncate(size)
+
+    def report(length):
+        nonlocal transferred
+        with lock:
+            transferred += length
+            if callback:
+                callback(transferred, size)
+
+    def fetch(start, length):
+        committed = offsets.get(start, 0)
+        if committed >= length:
+            return
+        channel = sftp if ranges == 1 else paramiko.SFTPClient.from_transport(transport)
+        fd = os.open(outpath, os.O_WRONLY)
+        try:
+            with channel.open(inpath, "rb") as remote:
+                end = start + length
+                pieces = [
+                    (offset, min(PIECE_SIZE, end - offset))
+                    for offset in range(start + committed, end, PIECE_SIZE)
+                ]
+                reads = remote.readv(
+                    pieces, max_concurrent_prefetch_requests=MAX_REQUESTS
+                )
+                unsaved = 0
+                for (offset, _), data in zip(pieces, reads):
+                    if failed.is_set():
+                        return
+                    os.pwrite(fd, data, offset)
+                    if hasher:
+                        hasher(offset, data)
+                    committed += len(data)
+                    unsaved += len(data)
+                    report(len(data))
+                    if throttle:
+                        throttle(len(data))
+                    if checkpoint and unsaved >= CHECKPOINT_SIZE:
+                        os.fdatasync(fd)
+                        checkpoint(start, committed)
+                        unsaved = 0
+        except Exception:
+            failed.set()
+            raise
+        finally:
+            os.close(fd)
+            if channel is not sftp:
+                channel.close()
+
+    report(0)
+    with ThreadPoolExecutor(max_workers=ranges) as executor:
+        futures = [
+            executor.submit(fetch, start, length)
+            for start, length in splitRanges(size, ranges)
+        ]
+        for future in futures:
+            future.result()
+
+
+def changedPieces(local, remote, size, blockSize):
+    # (offset, length) of each block whose remote digest differs from the
+    # local one at the same index.
+    return [
+        (index * blockSize, min(blockSize, size - index * blockSize))
+        for index, digest in enumerate(remote)
+        if index >= len(local) or local[index] != digest
+    ]
+
+
+def deltaGet(
+    sftp,
+    inpath,
+    basepath,
+    outpath,
+    size,
+    pieces,
+    callback=None,
+    throttle=None,
+    hasher=None,
+):
+    # Writes outpath front to back, taking pieces from the remote file and
+    # everything else from basepath, so hasher(offset, data) sees the whole
+    # file in order. Unchanged blocks count as already transferred, so an
+    # empty delta reports the whole file at once.
+    transferred = size - sum(length for _, length in pieces)
+    if callback:
+        callback(transferred, size)
+    written = 0
+
+    def write(out, data):
+        nonlocal written
+        out.write(data)
+        if hasher:
+            hasher(written, data)
+        written += len(data)
+
+    def copyBase(base, out, end):
+        base.seek(written)
+        while written < end:
+            data = base.read(min(PIECE_SIZE, end - written))
+            if not data:
+                raise EOFError(f"{basepath} is shorter than {end} bytes")
+            write(out, data)
+
+    with ExitStack() as stack:
+        base = stack.enter_context(open(basepath, "rb"))
+        out = stack.enter_context(open(outpath, "wb"))
+        reads = []
+        if pieces:
+            remote = stack.enter_context(sftp.open(inpath, "rb"))
+            reads = remote.readv(pieces, max_concurrent_prefetch_requests=MAX_REQUESTS)
+        for (offset, _), data in zip(pieces, reads):
+            copyBase(base, out, offset)
+            write(out, data)
+            transferred += len(data)
+            if callback:
+                callback(transferred, size)
+            if throttle:
+                throttle(len(data))
+        copyBase(base, out, size)